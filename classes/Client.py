@@ -3,9 +3,41 @@ Copyright (c) 2021 Philipp Scheer
 """
 
 
-import copy
 import time
-from jarvis import Database, Logger
+import random
+from jarvis import Logger
+from core.Cache import LRUCache
+from core.Couch import Table, ConflictError
+import core.Couch as Couch
+import core.Journal as Journal
+from core.WriteBehind import WriteBehind
+import core.Metrics as Metrics
+
+
+CACHE_SIZE = 4096
+"""
+Maximum amount of client documents kept in memory
+"""
+
+CACHE_TTL = 60 * 10
+"""
+Seconds until a cached client document is re-read from the database, even if no change was reported
+"""
+
+HEARTBEAT_INTERVAL = 30
+"""
+Seconds between two bulk writes of volatile client fields, see [`Client.touch`](#touch)
+"""
+
+SAVE_RETRIES = 5
+SAVE_BACKOFF = 0.01
+SAVE_BACKOFF_MAX = 0.5
+"""
+After a write conflict, [`Client.save`](#save) merges its changes into the latest revision and retries up to `SAVE_RETRIES` times  
+The first retry is immediate, further retries wait `SAVE_BACKOFF * 2^n` seconds (at most `SAVE_BACKOFF_MAX`) with jitter
+"""
+
+MISSING = object()
 
 
 logger = Logger("Client")
@@ -13,9 +45,13 @@ logger = Logger("Client")
 
 class Client():
     """
-    Client representing outside world devices and internal applications that connect through the MQTT API
+    Client representing outside world devices and internal applications that connect through the MQTT API  
+    The client remembers which fields changed since it was loaded, [`save`](#save) skips the write if nothing changed.
+    Documents are shared with the client cache, so modify fields with [`set`](#set) and [`set_data`](#set_data) only
     """
 
+    __slots__ = ["data", "_id", "_rev", "_dirty", "_base", "_new"]
+
     DEFAULTS = {
         "ip": "127.0.0.1",
         "data": {},
@@ -30,86 +66,335 @@ class Client():
     }
     """Default values when creating a new client"""
 
-    def __init__(self, client_object = {}) -> None:
+    CACHE = LRUCache(CACHE_SIZE, CACHE_TTL)
+    """Cache of raw client documents (including `_id` and `_rev`) keyed by client id  
+    Kept current by [`save`](#save) and invalidated by [`on_change`](#on_change)"""
+
+    VOLATILE_FIELDS = ["modified-at", "last-seen"]
+    """Fields which change on (almost) every request and are written in bulk by [`touch`](#touch)"""
+
+    INDEXES = {
+        "device-activated-last-seen": ["device", "activated", "last-seen"],
+        "device-last-seen": ["device", "last-seen"],
+        "activated-last-seen": ["activated", "last-seen"],
+        "last-seen": ["last-seen"],
+        "secure": ["secure"]
+    }
+    """Mango indexes of the `devices` table (name -> fields) used by [`query`](#query), created by `core/Checks`  
+    A compound index is only used if the query filters all of its fields, so the common filter combinations have their own index
+    and [`query`](#query) always filters `last-seen`"""
+
+    HEARTBEAT = WriteBehind("devices", HEARTBEAT_INTERVAL, lambda doc: Client.CACHE.set(doc["_id"], doc))
+    """Write-behind buffer for volatile fields, flushed every `HEARTBEAT_INTERVAL` seconds"""
+
+    def __init__(self, client_object: dict = None) -> None:
         """Initialize a new client with an object from the database"""
-        self.data = client_object
-        if "created-at" not in self.data or self.data["created-at"] is None:
-            self.data["created-at"]  = int(time.time())
-            self.data["modified-at"] = int(time.time())
-            self.data["last-seen"]   = int(time.time())
+        self.data = dict(client_object or {})
+        self._id = self.data.pop("_id", None)
+        self._rev = self.data.pop("_rev", None)
+        self.data.pop("id", None)
+        self._dirty = set()
+        self._base = None
+        self._new = self._rev is None
+        if self.data.get("created-at", None) is None:
+            self.set("created-at",  int(time.time()))
+            self.set("modified-at", int(time.time()))
+            self.set("last-seen",   int(time.time()))
 
     def save(self):
-        """Save the current client object into the database"""
-        self.data["modified-at"] = int(time.time())
-        if "id" in self.data:
-            self.data["_id"] = self._id
-            self.data["_rev"] = self._rev
-            del self.data["id"]
-
-        self.data["secure"] = self.data["public-key"] is not None
-
-        res = Database().table("devices").insert(self.data)
-        # after .insert(), `self.data` will have fields '_id' and '_rev'
-        self._id = self.data["_id"]
-        self._rev = self.data["_rev"]
-        del self.data["_id"]
-        del self.data["_rev"]
-        return res
+        """Save the current client object into the database  
+        Nothing is written if no field changed since the client was loaded or saved.
+        If the client was changed by someone else in the meantime, the changed fields are merged into the latest revision (see [`_resolve`](#_resolve))"""
+        if not self.changed:
+            return True
+        table = Couch.table("devices")
+        try:
+            self._put(table, self._doc())
+        except ConflictError:
+            self._resolve(table)
+        return True
 
     def get(self, key: str, or_else: any = None):
         """Get an element from the class data object"""
         if key == "id":
-            key = "_id"
+            return self._id
         return self.data.get(key, or_else)
 
     def set(self, key: str, value: any):
         """Set a specific key of the class data object"""
         self.data[key] = value
+        self._dirty.add(key)
 
     def get_data(self, key: str, or_else: any = None):
         """Get an element from the client data object"""
-        if key == "id":
-            key = "_id"
-        return self.data["data"].get(key, or_else)
+        return self.data.get("data", {}).get(key, or_else)
 
     def set_data(self, key: str, value: any):
         """Set a specific key of the client data object"""
+        if "data" not in self._dirty:
+            # copy on first write, the loaded dict is shared with the client cache
+            self.set("data", dict(self.data.get("data", None) or {}))
         self.data["data"][key] = value
 
     def reload(self):
-        cl = Client.load(self.id)
-        self.data = copy.deepcopy(cl.data)
-        del cl
+        """Replace all fields with the latest stored version, discarding unsaved changes"""
+        self._load(Client._fetch(self.id))
 
     @property
     def id(self):
         return self._id
 
+    @property
+    def dirty(self):
+        """Fields changed since the client was loaded or saved"""
+        return set(self._dirty)
+
+    @property
+    def changed(self):
+        """Check if the client has to be written, either because it was never saved or a field changed  
+        A client whose save was journaled (see `core/Journal`) has no revision yet, but is not written again"""
+        return self._new or len(self._dirty) > 0
+
+    def _doc(self):
+        """Build the document to write to the database"""
+        if "_id" in self.data:   # id assigned to a new client
+            self._id = self.data.pop("_id")
+        self.data["modified-at"] = int(time.time())
+        self.data["secure"] = self.data.get("public-key", None) is not None
+        doc = dict(self.data)
+        if self._id is not None:
+            doc["_id"] = self._id
+        if self._rev is not None:
+            doc["_rev"] = self._rev
+        return doc
+
+    def _put(self, table: Table, doc: dict):
+        """Write `doc`, raises a `ConflictError` if the revision is outdated  
+        If the database is unavailable the write is journaled and the client keeps its revision, see `core/Journal`.
+        The journal replays only the fields changed since the client was loaded, like [`_resolve`](#_resolve)"""
+        res = Journal.write(table, doc, self._base)
+        doc["_id"] = res["id"]
+        if res["rev"] is not None:
+            doc["_rev"] = res["rev"]
+        self._saved(doc)
+
+    def _resolve(self, table: Table):
+        """Resolve a write conflict: get the latest revision, merge the changed fields into it and write again  
+        Fields only we changed take our value, all other fields take the latest value, see [`merge`](#merge)"""
+        global logger
+        for attempt in range(SAVE_RETRIES):
+            Metrics.count("client-save-conflicts")
+            if attempt > 0:
+                time.sleep(min(SAVE_BACKOFF * 2 ** (attempt - 1), SAVE_BACKOFF_MAX) * random.uniform(0.5, 1))
+            latest = table.get(self._id)
+            if latest is None:
+                raise Exception(f"Client '{self._id}' was deleted while saving")
+            self._rebase(latest)
+            Metrics.count("client-save-retries")
+            try:
+                self._put(table, self._doc())
+                return
+            except ConflictError:
+                pass
+        Metrics.count("client-save-failures")
+        logger.e("Save", f"Failed to save client '{self._id}' after {SAVE_RETRIES} conflicts")
+        raise ConflictError(f"Client '{self._id}' could not be saved after {SAVE_RETRIES} conflicts")
+
+    def _rebase(self, latest: dict):
+        """Apply the changed fields on top of the `latest` document, the changes stay marked as dirty"""
+        base = self._base or {}
+        merged = { k: v for k, v in latest.items() if k != "_id" and k != "_rev" }
+        for key in self._dirty:
+            ours = self.data.get(key, MISSING)
+            theirs = merged.get(key, MISSING)
+            old = base.get(key, MISSING)
+            if isinstance(ours, dict) and isinstance(theirs, dict) and isinstance(old, dict):
+                ours = merge(old, ours, theirs)
+            if ours is MISSING:
+                merged.pop(key, None)
+            else:
+                merged[key] = ours
+        self.data = merged
+        self._rev = latest["_rev"]
+        self._base = latest
+
+    def _saved(self, doc: dict):
+        """Take the id and revision of a written document and keep the client cache current"""
+        Client.CACHE.set(doc["_id"], doc)
+        self._id = doc["_id"]
+        self._rev = doc.get("_rev", None)
+        self._dirty = set()
+        self._base = doc
+        self._new = False
+
+    def _load(self, doc: dict):
+        """Take the fields of a raw document, the top level dict is copied and nested values are shared  
+        Documents of journaled saves have no `_rev` until the journal is replayed"""
+        self.data = { k: v for k, v in doc.items() if k != "_id" and k != "_rev" }
+        self._id = doc["_id"]
+        self._rev = doc.get("_rev", None)
+        self._dirty = set()
+        self._base = doc
+        self._new = False
+
     @staticmethod
     def exists(id):
         """Check if a client with `id` exists"""
-        res = Database().table("devices").get(id)
+        if Client.CACHE.get(id, None) is not None:
+            return True
+        res = Couch.table("devices").get(id)
         return res is not None
 
     @staticmethod
     def load(id):
-        """Load a client from the database given its id"""
-        res = Database().table("devices").get(id)
-        if res:
-            res["id"] = res["_id"]
-            _id = res["_id"]
-            _rev = res["_rev"]
-            del res["_id"]
-            del res["_rev"]
-            c = Client(res)
-            c._id = _id
-            c._rev = _rev
-            return c
-        else:
-            raise Exception(f"No client found with id '{id}'")
+        """Load a client from the cache or the database given its id"""
+        c = Client.__new__(Client)
+        c._load(Client._fetch(id))
+        return c
+
+    @staticmethod
+    def load_many(ids: list):
+        """Load multiple clients with one database request, clients in the cache are not requested  
+        Returns a list of clients in the order of `ids`, ids without a client are left out"""
+        docs = { id: Client.CACHE.get(id, None) for id in ids }
+        missing = [id for id, doc in docs.items() if doc is None]
+        if missing:
+            for id, doc in Couch.table("devices").get_many(missing).items():
+                Client.CACHE.set(id, doc)
+                docs[id] = doc
+        clients = []
+        for id in ids:
+            if docs.get(id, None) is not None:
+                c = Client.__new__(Client)
+                c._load(docs[id])
+                clients.append(c)
+        return clients
+
+    @staticmethod
+    def save_many(clients: list):
+        """Save multiple clients with one database request, unchanged clients are skipped  
+        Conflicting clients are merged and saved one by one like [`save`](#save) does.
+        Returns a list of booleans in the order of `clients`, `False` if a client could not be saved"""
+        global logger
+        changed = [c for c in clients if c.changed]
+        if changed:
+            table = Couch.table("devices")
+            docs = [c._doc() for c in changed]
+            for c, doc, result in zip(changed, docs, table.bulk(docs)):
+                try:
+                    if result.get("ok", False):
+                        doc["_id"] = result["id"]
+                        doc["_rev"] = result["rev"]
+                        c._saved(doc)
+                    elif result.get("error", None) == "conflict":
+                        c._resolve(table)
+                    else:
+                        logger.w("Save", f"Failed to save client '{doc.get('_id', None)}': {result.get('error', None)}")
+                except Exception as e:
+                    logger.w("Save", f"Failed to save client '{doc.get('_id', None)}': {e}")
+        return [not c.changed for c in clients]
+
+    @staticmethod
+    def iter_all(batch_size: int = 500):
+        """Iterate over all clients, loading `batch_size` clients per database request  
+        Only one batch is held in memory at a time, the client cache is not filled"""
+        table = Couch.table("devices")
+        startkey, skip = None, 0
+        while True:
+            docs = table.all_docs(batch_size, startkey, skip)
+            for doc in docs:
+                if not doc["_id"].startswith("_design/"):
+                    c = Client.__new__(Client)
+                    c._load(doc)
+                    yield c
+            if len(docs) < batch_size:
+                return
+            startkey, skip = docs[-1]["_id"], 1
+
+    @staticmethod
+    def query(device: str = None, activated: bool = None, secure: bool = None, seen_since: int = None,
+              limit: int = 100, bookmark: str = None):
+        """Find clients by indexed fields (see [`INDEXES`](#INDEXES)), filters which are `None` are ignored  
+        `seen_since` is a unix timestamp, only clients with a `last-seen` at or after it match.
+        Returns a tuple `(clients, bookmark)`, pass the bookmark to get the next page. The client cache is not filled"""
+        selector = {}
+        if device is not None:
+            selector["device"] = device
+        if activated is not None:
+            selector["activated"] = activated
+        if secure is not None:
+            selector["secure"] = secure
+        if seen_since is not None:
+            selector["last-seen"] = { "$gte": seen_since }
+        if not selector:
+            selector["_id"] = { "$gt": None }
+        elif "last-seen" not in selector:
+            selector["last-seen"] = { "$gte": None }   # matches every value (null sorts first), but lets the compound indexes be used
+        docs, bookmark = Couch.table("devices").find(selector, limit, bookmark)
+        clients = []
+        for doc in docs:
+            c = Client.__new__(Client)
+            c._load(doc)
+            clients.append(c)
+        return (clients, bookmark)
+
+    @staticmethod
+    def _fetch(id):
+        """Get the raw document of a client from the cache or the database  
+        While the database is unavailable, an expired cache entry is used instead"""
+        res = Client.CACHE.get(id, None)
+        if res is None:
+            try:
+                res = Couch.table("devices").get(id)
+            except Exception as e:
+                res = Client.CACHE.peek(id, None)
+                if res is None or not Journal.unavailable(e):
+                    raise
+                return res
+            if not res:
+                raise Exception(f"No client found with id '{id}'")
+            Client.CACHE.set(id, res)
+        return res
+
+    @staticmethod
+    def touch(id, fields: dict):
+        """Update volatile fields (see [`VOLATILE_FIELDS`](#VOLATILE_FIELDS)) of a client without saving it  
+        The fields are written together with other clients in the next heartbeat flush"""
+        assert all(k in Client.VOLATILE_FIELDS for k in fields), f"Only volatile fields can be touched: {', '.join(Client.VOLATILE_FIELDS)}"
+        Client.HEARTBEAT.set(id, fields)
+
+    @staticmethod
+    def on_change(change):
+        """Invalidate the cached document of a client after a change in the `devices` table  
+        `change` is a result of the `_changes` feed, changes we wrote ourselves are kept"""
+        cached = Client.CACHE.peek(change["id"], None)
+        if cached is None:
+            return
+        if change.get("deleted", False) or cached.get("_rev", None) not in [c["rev"] for c in change["changes"]]:
+            Client.CACHE.invalidate(change["id"])
 
     @staticmethod
     def new(data):
         """Generate a new device with given data"""
         assert "id" not in data and "_id" not in data, "If you generate a new device, you cannot specify an id"
         return Client({**Client.DEFAULTS, **data})
+
+
+def merge(base: dict, ours: dict, theirs: dict):
+    """Three-way merge of two versions of a dict which were both derived from `base`  
+    Keys we changed (compared to `base`) take our value, all other keys take their value.
+    Nested dicts changed on both sides are merged the same way. If both sides changed a key to different values, ours wins"""
+    result = dict(theirs)
+    for key in set(base).union(ours):
+        mine = ours.get(key, MISSING)
+        old = base.get(key, MISSING)
+        if mine is old or mine == old:
+            continue
+        other = theirs.get(key, MISSING)
+        if isinstance(mine, dict) and isinstance(old, dict) and isinstance(other, dict):
+            mine = merge(old, mine, other)
+        if mine is MISSING:
+            result.pop(key, None)
+        else:
+            result[key] = mine
+    return result
@@ -3,9 +3,14 @@ Copyright (c) 2021 Philipp Scheer
 """
 
 
+import io
+import csv
+import json
 import time
-import random
-from jarvis.Database import Database
+import secrets
+import core.Couch as Couch
+import core.Journal as Journal
+from core.TokenStore import TokenStore
 
 
 TOKEN_LENGTH = 8
@@ -19,16 +24,27 @@ TOKEN_EXPIRATION_SECONDS = 120
 Amount of seconds until an issued token expires. Currently 2min
 """
 
+MAX_ISSUE = 10000
+"""
+Maximum amount of tokens issued at once by [`Token.new_many`](#new_many)
+"""
+
+EXPORT_FIELDS = ["token", "permission", "requested-at", "expires-at"]
+"""
+Fields of a token written by [`Token.export`](#export)
+"""
+
 
 class Token():
     """
-    A helper class to issue tokens to registering devices
+    A helper class to issue tokens to registering devices  
+    Token documents are keyed by their token value, live tokens are served from memory by [`STORE`](#STORE)
     """
 
     REQUIREMENTS = {
         "token": str,
         "permission": int, 
-        "requested-at": list,
+        "requested-at": int,
         "expires-at": int,
         "redeemed": bool
     }
@@ -36,6 +52,14 @@ class Token():
     Required fields that have to be in a token object
     """
 
+    INDEXES = {
+        "expires-at": ["expires-at"]
+    }
+    """Mango indexes of the `tokens` table (name -> fields), used to load live and purge expired tokens"""
+
+    STORE = TokenStore("tokens")
+    """Live tokens kept in memory and evicted once they expire, see [`core/TokenStore`](core/TokenStore)"""
+
     def __init__(self, token, permission) -> None:
         """
         Initialize a token with no rights
@@ -54,28 +78,31 @@ class Token():
         Save the current token to the database
         """
         self.check()
-        Database().table("tokens").insert(self.data)
+        doc = { **self.data, "_id": self.data["token"] }
+        res = Journal.write(Couch.table("tokens"), doc)
+        if res["rev"] is not None:
+            doc["_rev"] = res["rev"]
+        self.data = doc
+        Token.STORE.add(doc)
         return self
 
     def update(self):
         """
-        Load the most recent token information into this class
+        Load the most recent token information into this class  
+        Expired tokens cannot be found anymore
         """
-        info = Database().table("tokens").find({ "token": { "$eq": self.token } })
-        if info.found:
-            info = info[0]
-            self.data = info
-            self.check()
-        else:
+        info = Token.STORE.get(self.token)
+        if info is None:
             raise Exception("token could not be found")
+        self.data = info
+        self.check()
         return self
 
     def is_expired(self):
         """
         Check if the token expired
         """
-        self.update()
-        return self.data["expires"] < time.time()
+        return self.data["expires-at"] < time.time()
             
     def is_redeemed(self):
         """
@@ -88,7 +115,6 @@ class Token():
         """
         Check if the registered token belongs to an app
         """
-        self.update()
         return self.data["token"].startswith("app:")
     
     def check(self):
@@ -107,10 +133,13 @@ class Token():
     @staticmethod
     def load(token):
         """
-        Load a token from the database
+        Load a live token from the token store
         """
-        token = Token(token, 0)
-        token.update()
+        info = Token.STORE.get(token)
+        if info is None:
+            raise Exception("token could not be found")
+        token = Token.__new__(Token)
+        token.data = info
         return token
 
     @staticmethod
@@ -118,10 +147,72 @@ class Token():
         """
         Create a new random token with given permissions
         """
-        token = ''.join(random.choice("abcdef0123456789") for _ in range(TOKEN_LENGTH))
+        token = secrets.token_hex(TOKEN_LENGTH // 2)
         token = Token(token, permission)
         return token
 
+    @staticmethod
+    def new_many(count: int, permission: int, expires_in: int = TOKEN_EXPIRATION_SECONDS):
+        """
+        Create and save `count` random tokens with given permissions in one bulk request  
+        Tokens are checked for collisions with each other and with the live tokens in memory,
+        tokens colliding with an (expired, not yet purged) database document are regenerated
+        """
+        assert 0 < count <= MAX_ISSUE, f"Between 1 and {MAX_ISSUE} tokens can be issued at once"
+        now = int(time.time())
+        issued = []
+        table = Couch.table("tokens")
+        while len(issued) < count:
+            docs = {}
+            while len(docs) < count - len(issued):
+                value = secrets.token_hex(TOKEN_LENGTH // 2)
+                if value not in docs and not Token.STORE.contains(value):
+                    docs[value] = {
+                        "_id": value,
+                        "token": value,
+                        "permission": permission,
+                        "requested-at": now,
+                        "expires-at": now + expires_in,
+                        "redeemed": False
+                    }
+            docs = list(docs.values())
+            for doc, result in zip(docs, table.bulk(docs)):
+                if result.get("ok", False):
+                    doc["_rev"] = result["rev"]
+                    issued.append(doc)
+                elif result.get("error", None) != "conflict":
+                    raise Exception(f"Failed to save token: {result.get('reason', result.get('error', None))}")
+        Token.STORE.add_many(issued)
+        tokens = []
+        for doc in issued:
+            token = Token.__new__(Token)
+            token.data = doc
+            tokens.append(token)
+        return tokens
+
+    @staticmethod
+    def export(tokens: list, format: str = "csv"):
+        """
+        Export tokens as `csv` (with a header line) or `json` (an array of objects), see [`EXPORT_FIELDS`](#EXPORT_FIELDS)  
+        Yields the export in chunks of one token each, so large exports can be written without building them in memory
+        """
+        assert format in ["csv", "json"], "Format has to be 'csv' or 'json'"
+        if format == "csv":
+            line = io.StringIO()
+            writer = csv.writer(line)
+            writer.writerow(EXPORT_FIELDS)
+            for token in tokens:
+                yield line.getvalue()
+                line.seek(0)
+                line.truncate()
+                writer.writerow([token.data[k] for k in EXPORT_FIELDS])
+            yield line.getvalue()
+        else:
+            yield "["
+            for i, token in enumerate(tokens):
+                yield ("," if i else "") + json.dumps({ k: token.data[k] for k in EXPORT_FIELDS })
+            yield "]"
+
     @staticmethod
     def static(token, permission):
         """
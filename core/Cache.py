@@ -0,0 +1,81 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache():
+    """
+    A bounded, thread-safe least-recently-used cache with an optional time to live
+    Entries older than `ttl` seconds are treated as missing, the least recently used entry is evicted once `maxsize` is reached
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None) -> None:
+        """Initialize an empty cache holding at most `maxsize` entries, each for at most `ttl` seconds (`None` = forever)"""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, or_else: any = None):
+        """Get an entry from the cache and mark it as recently used, return `or_else` if it is missing or expired"""
+        with self._lock:
+            entry = self._data.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return or_else
+            value, stored_at = entry
+            if self.ttl is not None and stored_at + self.ttl < time.time():
+                self.misses += 1   # kept for `peek` until it is replaced or evicted
+                return or_else
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, or_else: any = None):
+        """Get an entry without counting a hit or miss and without marking it as recently used, expired entries are returned as well"""
+        with self._lock:
+            entry = self._data.get(key, None)
+            return or_else if entry is None else entry[0]
+
+    def set(self, key, value):
+        """Store an entry in the cache, evict the least recently used entries if the cache is full"""
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Remove an entry from the cache, returns `True` if the entry existed"""
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Get the cache counters"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max-size": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit-rate": self.hits / total if total else 0
+            }
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,107 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import time
+import threading
+import traceback
+from jarvis import Logger, Exiter
+import core.Couch as Couch
+
+
+RETRY_INTERVAL = 5   # seconds to wait before following a feed again after an error
+
+
+logger = Logger("Changes")
+
+
+class Feed():
+    """
+    Follows the `_changes` feed of one table in a background thread and calls all subscribed callbacks for every change
+    Starts at the current sequence and resumes from the last seen sequence after an error, so no change is missed.
+    Documents are included in the changes if at least one subscriber asked for them
+    """
+
+    def __init__(self, table: str) -> None:
+        """Initialize a feed for `table`, it is started by the first [`subscribe`](#subscribe)"""
+        self.table = table
+        self.since = "now"
+        self.changes = 0
+        self.errors = 0
+        self._callbacks = []  # (callback, include_docs)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, callback, include_docs: bool = False):
+        """Call `callback(change)` for every following change of the table"""
+        with self._lock:
+            self._callbacks.append((callback, include_docs))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.loop, name=f"changes {self.table}", daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self, callback):
+        """Stop calling `callback`"""
+        with self._lock:
+            self._callbacks = [c for c in self._callbacks if c[0] is not callback]
+
+    def loop(self):
+        """Wait for changes and call the callbacks until Jarvis stops"""
+        global logger
+        handle = Couch.table(self.table)
+        while Exiter.running:
+            include_docs = any(c[1] for c in self._callbacks)
+            try:
+                results, self.since = handle.changes(self.since, include_docs=include_docs)
+            except Exception:
+                self.errors += 1
+                logger.e("Feed", f"Failed to follow changes of table '{self.table}', retrying in {RETRY_INTERVAL}s", traceback.format_exc())
+                time.sleep(RETRY_INTERVAL)
+                continue
+            for change in results:
+                self.changes += 1
+                for callback, _ in self._callbacks:
+                    try:
+                        callback(change)
+                    except Exception:
+                        logger.e("Callback", f"Change callback for table '{self.table}' failed", traceback.format_exc())
+
+    def stats(self):
+        """Get feed counters"""
+        return {
+            "subscribers": len(self._callbacks),
+            "changes": self.changes,
+            "errors": self.errors,
+            "running": self._thread is not None and self._thread.is_alive()
+        }
+
+
+feeds = {}  # table -> Feed
+feeds_lock = threading.Lock()
+
+
+def subscribe(table: str, callback, include_docs: bool = False):
+    """Call `callback(change)` for every change of `table`, with the changed document in `change["doc"]` if `include_docs` is set
+    All subscribers of a table share one `_changes` request. Returns `callback`, to be passed to [`unsubscribe`](#unsubscribe)"""
+    global feeds, feeds_lock
+    with feeds_lock:
+        feed = feeds.get(table, None)
+        if feed is None:
+            feed = feeds[table] = Feed(table)
+    feed.subscribe(callback, include_docs)
+    return callback
+
+
+def unsubscribe(table: str, callback):
+    """Stop calling `callback` for changes of `table`, the feed keeps running for other subscribers"""
+    global feeds
+    feed = feeds.get(table, None)
+    if feed is not None:
+        feed.unsubscribe(callback)
+
+
+def stats():
+    """Get the counters of all feeds"""
+    global feeds
+    return { table: feed.stats() for table, feed in list(feeds.items()) }
@@ -25,6 +25,8 @@ def check_system(skip_checks: bool = False):
         logger.w("Skip", "Skipping checks is not recommended")
         return
     _check_database()
+    if not do_exit:
+        _check_indexes()
     if do_exit:
         _err("Requirements are not met. Jarvis cannot run")
         exit(1)
@@ -39,12 +41,38 @@ def check_system(skip_checks: bool = False):
 def _check_database():
     """
     Check if the database is up.  
-    The connection is checked and also credentials
+    The connection is checked and also credentials, the SQLite backend only needs a writable database file.
+    Jarvis needs the database to start (the server keys and client are read on startup),
+    outages while Jarvis is running are bridged by journaling writes (see `core/Journal`)
     """
-    if not Database(exit_on_fail=False).up:
+    import core.Couch as Couch
+    if Couch.BACKEND == "sqlite":
+        import core.SQLite as SQLite
+        if not SQLite.up():
+            _err(f"SQLite database '{SQLite.FILENAME}' cannot be opened")
+    elif not Database(exit_on_fail=False).up:
         _err("Database is not running")
 
 
+def _check_indexes():
+    """
+    Create missing database indexes declared by the classes (eg. [`Client.INDEXES`](classes/Client#INDEXES))  
+    A missing index makes queries slow but does not stop Jarvis
+    """
+    global logger
+    from classes.Client import Client
+    from classes.Token import Token
+    import core.Couch as Couch
+    for table, indexes in [("devices", Client.INDEXES), ("tokens", Token.INDEXES)]:
+        handle = Couch.table(table)
+        for name, fields in indexes.items():
+            try:
+                if handle.create_index(name, fields):
+                    logger.i("Index", f"Created index '{name}' on table '{table}'")
+            except Exception as e:
+                logger.w("Index", f"Could not create index '{name}' on table '{table}': {e}")
+
+
 def _err(msg):
     """
     Log an error and mark that Jarvis cannot run
@@ -0,0 +1,152 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import threading
+import traceback
+import jarvis
+from jarvis import Logger
+import core.Couch as Couch
+import core.Changes as Changes
+
+
+LOAD_BATCH = 500   # amount of config documents loaded per request
+
+MISSING = object()
+
+
+logger = Logger("Config")
+
+
+class Config():
+    """
+    Drop-in replacement for `jarvis.Config` which keeps all config values in memory
+    The `config` table is loaded once on the first [`get`](#get), [`set`](#set) writes through to the database
+    and changes of other processes (eg. `setup.py`) are applied from the `_changes` feed by [`on_change`](#on_change).
+    Subscribe to `core/Changes` for the `config` table to react to changes, the cache is updated before other subscribers are called.
+    Returned values are shared between all callers, do not modify them in place
+    """
+
+    TABLE = "config"
+
+    values = {}  # key -> value, MISSING for keys known not to exist
+    ids = {}  # document id -> key
+    loaded = False
+    subscribed = False
+    lock = threading.Lock()
+    backend = None  # jarvis.Config, used for writes and for reads if the table could not be loaded
+
+    def get(self, key: str, or_else: any = None):
+        """Get a config value, `or_else` if the key does not exist"""
+        value = Config.values.get(key, None)
+        if value is None:
+            if not Config.loaded:
+                Config.load()
+            if key not in Config.values:
+                value = Config._backend().get(key, MISSING)
+                Config.values[key] = value
+            value = Config.values[key]
+        return or_else if value is MISSING else value
+
+    def set(self, key: str, value: any):
+        """Set a config value, the value is written to the database before it is cached  
+        If the database is unavailable, the value is cached and the write is journaled (see `core/Journal`)"""
+        global logger
+        import core.Journal as Journal
+        result = True
+        if Journal.journal.pending:   # keep the order of journaled writes
+            Journal.journal.append({ "config": key, "value": value })
+        else:
+            try:
+                result = Config._backend().set(key, value)
+            except Exception as e:
+                logger.w("Set", f"Failed to write config value '{key}', journaling the write: {e}")
+                Journal.journal.append({ "config": key, "value": value })
+        Config.values[key] = value
+        return result
+
+    @staticmethod
+    def load():
+        """Load all config values of the `config` table
+        Documents have the form `{"key": str, "value": any}`, if the table cannot be read values are loaded key by key"""
+        global logger
+        with Config.lock:
+            if Config.loaded:
+                return
+            if not Config.subscribed:   # before loading, so no change gets lost
+                Changes.subscribe(Config.TABLE, Config.on_change, include_docs=True)
+                Config.subscribed = True
+            try:
+                values, ids = {}, {}
+                table = Couch.table(Config.TABLE)
+                startkey, skip = None, 0
+                while True:
+                    docs = table.all_docs(LOAD_BATCH, startkey, skip)
+                    for doc in docs:
+                        if "key" in doc and "value" in doc:
+                            values[doc["key"]] = doc["value"]
+                            ids[doc["_id"]] = doc["key"]
+                    if len(docs) < LOAD_BATCH:
+                        break
+                    startkey, skip = docs[-1]["_id"], 1
+                Config.values.update(values)
+                Config.ids.update(ids)
+            except Exception:
+                logger.w("Load", "Failed to load the config table, loading values on demand", traceback.format_exc())
+            Config.loaded = True
+
+    @staticmethod
+    def on_change(change):
+        """Apply a change of the `config` table, `change` is a result of the `_changes` feed with `include_docs`
+        Unknown documents clear the cache, so all values are loaded again"""
+        doc = change.get("doc", None) or {}
+        key = doc.get("key", Config.ids.get(change["id"], None))
+        if key is None:
+            Config.clear()
+        elif change.get("deleted", False):
+            Config.values[key] = MISSING
+            Config.ids.pop(change["id"], None)
+        elif "value" in doc:
+            Config.values[key] = doc["value"]
+            Config.ids[change["id"]] = key
+        else:
+            Config.values.pop(key, None)
+
+    @staticmethod
+    def clear():
+        """Drop all cached values, the table is loaded again on the next [`get`](#get)"""
+        with Config.lock:
+            Config.values = {}
+            Config.ids = {}
+            Config.loaded = False
+
+    @staticmethod
+    def stats():
+        """Get the amount of cached values"""
+        return {
+            "values": len([v for v in list(Config.values.values()) if v is not MISSING]),
+            "loaded": Config.loaded
+        }
+
+    @staticmethod
+    def _backend():
+        if Config.backend is None:
+            Config.backend = jarvis.Config() if Couch.BACKEND == "couchdb" else TableConfig()
+        return Config.backend
+
+
+class TableConfig():
+    """
+    Reads and writes config documents (`{"key": str, "value": any}`) directly, used instead of `jarvis.Config` if the tables are not stored in CouchDB
+    """
+
+    def get(self, key: str, or_else: any = None):
+        docs, _ = Couch.table(Config.TABLE).find({ "key": key }, 1)
+        return docs[0]["value"] if docs else or_else
+
+    def set(self, key: str, value: any):
+        table = Couch.table(Config.TABLE)
+        docs, _ = table.find({ "key": key }, 1)
+        table.put({ **(docs[0] if docs else {}), "key": key, "value": value })
+        return True
@@ -0,0 +1,272 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import os
+import json
+import time
+import queue
+import inspect
+import requests
+import threading
+from urllib.parse import quote
+from jarvis import Logger, Database
+
+
+def _database_default(name: str, fallback: any):
+    """Get the default of the `jarvis.Database` argument `name`, so both connect to the same server"""
+    try:
+        default = inspect.signature(Database.__init__).parameters[name].default
+        return fallback if default is inspect.Parameter.empty else default
+    except (KeyError, TypeError, ValueError):
+        return fallback
+
+
+HOST     = os.environ.get("JARVIS_DATABASE_HOST", _database_default("hostname", "127.0.0.1"))
+PORT     = int(os.environ.get("JARVIS_DATABASE_PORT", _database_default("port", 5984)))
+USERNAME = os.environ.get("JARVIS_DATABASE_USERNAME", _database_default("username", "jarvis"))
+PASSWORD = os.environ.get("JARVIS_DATABASE_PASSWORD", _database_default("password", "jarvis"))
+"""
+Connection details of the CouchDB server, the defaults are taken from `jarvis.Database`  
+Set with the `JARVIS_DATABASE_HOST`, `JARVIS_DATABASE_PORT`, `JARVIS_DATABASE_USERNAME` and `JARVIS_DATABASE_PASSWORD` environment variables
+"""
+
+FEED_TIMEOUT = 30
+"""
+Seconds a long-poll request on a `_changes` feed may stay open before it returns with no results
+"""
+
+BACKEND = os.environ.get("JARVIS_DATABASE", "couchdb")
+"""
+Storage backend of all tables: `couchdb` (default) or `sqlite` for single-board deployments without CouchDB, see [`core/SQLite`](core/SQLite)  
+Set with the `JARVIS_DATABASE` environment variable
+"""
+
+POOL_SIZE = 8
+"""
+Maximum amount of concurrent requests to CouchDB (and of kept-alive connections), further requests wait for a free connection  
+Long-poll `_changes` requests use their own connection per table and do not count
+"""
+
+
+logger = Logger("Couch")
+
+
+class Pool():
+    """
+    A bounded, thread-safe pool of keep-alive HTTP sessions shared by all tables of the process
+    Connections are reused instead of paying the TCP and authentication setup on every request
+    """
+
+    def __init__(self, size: int = POOL_SIZE) -> None:
+        """Initialize a pool of at most `size` sessions, sessions are created on demand"""
+        self.size = size
+        self.created = 0
+        self.requests = 0
+        self.waited = 0
+        self.wait_time = 0
+        self.max_wait = 0
+        self._idle = queue.LifoQueue()   # the most recently used session has the warmest connection
+        self._free = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def request(self, method: str, url: str, **kwargs):
+        """Send a request with a pooled session, waits if all sessions are in use"""
+        session = self.acquire()
+        try:
+            return session.request(method, url, **kwargs)
+        finally:
+            self.release(session)
+
+    def acquire(self):
+        """Take a session from the pool, call [`release`](#release) once the response was read"""
+        start = time.perf_counter()
+        if not self._free.acquire(blocking=False):
+            self._free.acquire()
+            waited = time.perf_counter() - start
+            with self._lock:
+                self.waited += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+        with self._lock:
+            self.requests += 1
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self.created += 1
+            return session()
+
+    def release(self, session: requests.Session):
+        """Put a session back into the pool"""
+        self._idle.put(session)
+        self._free.release()
+
+    def stats(self):
+        """Get pool counters"""
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self.created,
+                "idle": self._idle.qsize(),
+                "requests": self.requests,
+                "waited": self.waited,
+                "wait-time": {
+                    "avg": self.wait_time / self.waited if self.waited else 0,
+                    "max": self.max_wait
+                }
+            }
+
+
+def session():
+    """Create a keep-alive HTTP session authenticated for CouchDB"""
+    s = requests.Session()
+    s.auth = (USERNAME, PASSWORD)
+    return s
+
+
+pool = Pool(POOL_SIZE)
+tables = {}  # name -> Table
+tables_lock = threading.Lock()
+
+
+def table(name: str):
+    """Get the shared handle of the table `name`, a [`Table`](#Table) or a `core/SQLite.Table` depending on the [`BACKEND`](#BACKEND)"""
+    global tables, tables_lock, BACKEND
+    handle = tables.get(name, None)
+    if handle is None:
+        with tables_lock:
+            if BACKEND == "sqlite":
+                import core.SQLite as SQLite
+                handle = tables.setdefault(name, SQLite.Table(name))
+            else:
+                handle = tables.setdefault(name, Table(name))
+    return handle
+
+
+def request(method: str, path: str, **kwargs):
+    """Send a request to `path` relative to the CouchDB server url with a pooled session"""
+    global pool
+    return pool.request(method, f"http://{HOST}:{PORT}/{path}", **kwargs)
+
+
+def node_stats():
+    """Get the statistics of the CouchDB node (reads, writes, status codes, ...)"""
+    res = request("GET", "_node/_local/_stats")
+    res.raise_for_status()
+    return res.json()
+
+
+class ConflictError(Exception):
+    """Raised if a document was written with an outdated revision"""
+    pass
+
+
+class Table():
+    """
+    Direct HTTP access to a CouchDB database (a `Database().table(...)` in Jarvis terms)
+    Follow the `_changes` feed of a table with [`core/Changes`](core/Changes) instead of calling [`changes`](#changes) in a loop
+    Requests share the keep-alive sessions of the [`pool`](#pool), get shared handles with [`table`](#table)
+    """
+
+    def __init__(self, name: str) -> None:
+        """Initialize a handle for the table `name`"""
+        self.name = name
+        self.url = f"http://{HOST}:{PORT}/{name}"
+        self._feed = None   # session of the long-poll `_changes` requests
+
+    def request(self, method: str, path: str = "", **kwargs):
+        """Send a request to `path` relative to the table url and return the response"""
+        global pool
+        return pool.request(method, f"{self.url}/{path}", **kwargs)
+
+    def get(self, id: str):
+        """Get the latest revision of the document `id`, bypassing all caches  
+        Returns `None` if the document does not exist"""
+        res = self.request("GET", quote(id, safe=""))
+        if res.status_code == 404:
+            return None
+        res.raise_for_status()
+        return res.json()
+
+    def put(self, doc: dict, timeout: float = None):
+        """Insert or update a single document, a document without `_id` gets an id assigned by CouchDB  
+        Returns `{"ok": True, "id": str, "rev": str}`, raises a `ConflictError` if `doc["_rev"]` is outdated"""
+        if "_id" in doc:
+            res = self.request("PUT", quote(doc["_id"], safe=""), json=doc, timeout=timeout)
+        else:
+            res = self.request("POST", json=doc, timeout=timeout)
+        if res.status_code == 409:
+            raise ConflictError(f"Document '{doc.get('_id', None)}' was changed since revision '{doc.get('_rev', None)}'")
+        res.raise_for_status()
+        return res.json()
+
+    def get_many(self, ids: list):
+        """Get the documents with the given `ids` in one request  
+        Returns a dict of id -> document, missing documents are left out"""
+        res = self.request("POST", "_all_docs", params={"include_docs": "true"}, json={"keys": list(ids)})
+        res.raise_for_status()
+        return {row["id"]: row["doc"] for row in res.json()["rows"] if row.get("doc", None) is not None}
+
+    def all_docs(self, limit: int, startkey: str = None, skip: int = 0):
+        """Get up to `limit` documents ordered by id, starting at id `startkey`  
+        Returns a list of documents, design documents are included"""
+        params = { "include_docs": "true", "limit": limit, "skip": skip }
+        if startkey is not None:
+            params["startkey"] = json.dumps(startkey)
+        res = self.request("GET", "_all_docs", params=params)
+        res.raise_for_status()
+        return [row["doc"] for row in res.json()["rows"] if row.get("doc", None) is not None]
+
+    def bulk(self, docs: list):
+        """Insert or update `docs` in one request  
+        Returns a list of `{"id": str, "rev": str, "ok": True}` or `{"id": str, "error": str, "reason": str}` in the same order as `docs`"""
+        res = self.request("POST", "_bulk_docs", json={"docs": docs})
+        res.raise_for_status()
+        return res.json()
+
+    def find(self, selector: dict, limit: int = 25, bookmark: str = None, sort: list = None, fields: list = None):
+        """Run a Mango query, at most `limit` documents are returned, only with `fields` if given  
+        Pass the returned bookmark to get the next page. Returns a tuple `(documents, bookmark)`"""
+        query = { "selector": selector, "limit": limit }
+        if bookmark is not None:
+            query["bookmark"] = bookmark
+        if sort is not None:
+            query["sort"] = sort
+        if fields is not None:
+            query["fields"] = fields
+        res = self.request("POST", "_find", json=query)
+        res.raise_for_status()
+        res = res.json()
+        if "warning" in res:
+            logger.d("Find", f"Query on table '{self.name}': {res['warning']}")
+        return (res["docs"], res.get("bookmark", None))
+
+    def create_index(self, name: str, fields: list):
+        """Create a Mango index `name` on `fields` if it does not exist yet  
+        Returns `True` if the index was created, `False` if it already existed"""
+        res = self.request("POST", "_index", json={
+            "index": { "fields": fields },
+            "name": name,
+            "ddoc": f"index-{name}",
+            "type": "json"
+        })
+        res.raise_for_status()
+        return res.json().get("result", None) == "created"
+
+    def changes(self, since: str = "now", timeout: int = FEED_TIMEOUT, include_docs: bool = False):
+        """Wait up to `timeout` seconds for changes after sequence `since`
+        Returns a tuple `(results, last_seq)` where `results` is a list of `{"id": str, "seq": str, "changes": [{"rev": str}], "deleted?": bool, "doc?": dict}`"""
+        if self._feed is None:
+            self._feed = session()
+        res = self._feed.get(f"{self.url}/_changes", params={
+            "feed": "longpoll",
+            "since": since,
+            "timeout": int(timeout * 1000),
+            "include_docs": "true" if include_docs else "false"
+        }, timeout=timeout + 10)
+        res.raise_for_status()
+        res = res.json()
+        return (res["results"], res["last_seq"])
+
@@ -0,0 +1,104 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import time
+import queue
+import threading
+import traceback
+from collections import deque
+from jarvis import Logger, Exiter, ThreadPool
+
+
+logger = Logger("Dispatcher")
+
+
+class Dispatcher():
+    """
+    Runs handlers on a bounded pool of worker threads
+    Work items are grouped by a key (eg. the client id): items with the same key run one after another in submission order,
+    items with different keys run concurrently
+    """
+
+    def __init__(self, handler, workers: int = 8, max_pending: int = 256, name: str = "worker") -> None:
+        """Initialize a dispatcher which calls `handler(*args)` for every submitted item
+        At most `max_pending` items may be queued or running at the same time"""
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.name = name
+        self.tpool = ThreadPool(logger)
+        self._pending = {}  # key -> deque of (submitted_at, args), exists while a worker is scheduled for this key
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._count = 0
+        self._active = 0
+        self._rejected = 0
+        self._processed = 0
+        self._wait_total = 0
+        self._wait_max = 0
+
+    def start(self):
+        """Start the worker threads"""
+        for i in range(self.workers):
+            self.tpool.register(self._work, f"{self.name} {i}")
+
+    def submit(self, key, *args):
+        """Queue `handler(*args)` behind all pending items with the same `key`
+        Returns `False` without queueing if the dispatcher is full"""
+        with self._lock:
+            if self._count >= self.max_pending:
+                self._rejected += 1
+                return False
+            self._count += 1
+            item = (time.time(), args)
+            if key in self._pending:
+                self._pending[key].append(item)
+            else:
+                self._pending[key] = deque([item])
+                self._ready.put(key)
+        return True
+
+    def stats(self):
+        """Get queue depth and wait time statistics"""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "active": self._active,
+                "pending": self._count,
+                "max-pending": self.max_pending,
+                "processed": self._processed,
+                "rejected": self._rejected,
+                "wait-time": {
+                    "avg": self._wait_total / self._processed if self._processed else 0,
+                    "max": self._wait_max
+                }
+            }
+
+    def _work(self):
+        """Worker loop, takes the next key which has pending items and runs its oldest item"""
+        global logger
+        while Exiter.running:
+            try:
+                key = self._ready.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self._lock:
+                submitted_at, args = self._pending[key].popleft()
+                self._active += 1
+            waited = time.time() - submitted_at
+            try:
+                self.handler(*args)
+            except Exception:
+                logger.e("Handler", f"Unhandled exception in {self.name} for '{key}'", traceback.format_exc())
+            with self._lock:
+                self._count -= 1
+                self._active -= 1
+                self._processed += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                if self._pending[key]:
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
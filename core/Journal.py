@@ -0,0 +1,204 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+import requests
+from jarvis import Logger, Exiter
+import core.Couch as Couch
+from core.Couch import ConflictError
+
+
+FILENAME = f"{os.path.dirname(os.path.abspath(__file__))}/../../data/journal.jsonl"   # append-only journal of queued writes
+SYNC_INTERVAL = 0.5   # seconds between two fsyncs of the journal, appends in between are synced together
+DRAIN_INTERVAL = 5   # seconds between two attempts to replay the journal
+DRAIN_BATCH = 500   # amount of documents replayed per bulk request
+WRITE_TIMEOUT = 2   # seconds a direct write may take before the document is queued instead
+
+
+logger = Logger("Journal")
+
+
+class Journal():
+    """
+    An append-only file of writes which could not be sent to the database (because it is unreachable or slow)
+    Appends only write to the page cache, a background thread fsyncs all appends of the last `SYNC_INTERVAL` seconds at once.
+    [`drain`](#drain) replays the journal in bulk once the database is reachable again
+    """
+
+    def __init__(self, filename: str) -> None:
+        """Initialize a journal stored in `filename`, entries of a previous run are replayed as well"""
+        self.filename = filename
+        self.draining = f"{filename}.draining"
+        self.appended = 0
+        self.replayed = 0
+        self.failed = 0
+        self._file = None
+        self._unsynced = False
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._pending = os.path.isfile(self.filename) or os.path.isfile(self.draining)
+
+    @property
+    def pending(self):
+        """Check if the journal holds writes which were not replayed yet"""
+        return self._pending
+
+    def append(self, entry: dict):
+        """Append an entry, either `{"table": str, "doc": dict, "base?": dict}` or `{"config": str, "value": any}`"""
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+                self._file = open(self.filename, "a")
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced = True
+            self._pending = True
+            self.appended += 1
+
+    def sync(self):
+        """Make all appended entries durable"""
+        with self._lock:
+            if self._file is not None and self._unsynced:
+                os.fsync(self._file.fileno())
+                self._unsynced = False
+
+    def drain(self):
+        """Replay all journaled writes, returns the amount of replayed entries
+        Raises an exception (and keeps the entries) if the database is still unavailable"""
+        with self._drain_lock:
+            if not os.path.isfile(self.draining):
+                with self._lock:
+                    if self._file is not None:
+                        os.fsync(self._file.fileno())
+                        self._file.close()
+                        self._file = None
+                        self._unsynced = False
+                    if not os.path.isfile(self.filename):
+                        self._pending = False
+                        return 0
+                    os.replace(self.filename, self.draining)   # new appends go to a new file
+            entries = []
+            with open(self.draining, "r") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        pass   # torn write of a crash
+            replay(entries)
+            os.unlink(self.draining)
+            with self._lock:
+                self._pending = self._file is not None   # entries appended while replaying
+            self.replayed += len(entries)
+            return len(entries)
+
+    def loop(self):
+        """Sync the journal every `SYNC_INTERVAL` seconds and try to drain it every `DRAIN_INTERVAL` seconds until Jarvis stops"""
+        global logger
+        last_drain = 0
+        while Exiter.running:
+            time.sleep(SYNC_INTERVAL)
+            self.sync()
+            if self.pending and time.time() - last_drain > DRAIN_INTERVAL:
+                last_drain = time.time()
+                try:
+                    n = self.drain()
+                    if n:
+                        logger.i("Drain", f"Replayed {n} journaled writes")
+                except Exception as e:
+                    self.failed += 1
+                    logger.w("Drain", f"Database still unavailable, keeping journaled writes: {e}")
+        self.sync()
+
+    def stats(self):
+        """Get journal counters"""
+        return {
+            "pending": self.pending,
+            "appended": self.appended,
+            "replayed": self.replayed,
+            "failed-drains": self.failed
+        }
+
+
+def replay(entries: list):
+    """Write journaled entries in order, documents are written in bulk per table
+    Documents journaled with a `base` only apply the fields changed since `base` to the latest revision (see `classes/Client.merge`),
+    so changes written by others during the outage are kept. Documents without a `base` replace the latest revision"""
+    from classes.Client import merge
+    docs = {}  # table -> { id: (doc, base) }, later writes of a document replace earlier ones but keep the first base
+    for entry in entries:
+        if "config" in entry:
+            from core.Config import Config
+            Config._backend().set(entry["config"], entry["value"])
+        else:
+            table_docs = docs.setdefault(entry["table"], {})
+            id = entry["doc"]["_id"]
+            base = table_docs[id][1] if id in table_docs else entry.get("base", None)
+            table_docs[id] = (entry["doc"], base)
+    for name, table_docs in docs.items():
+        table = Couch.table(name)
+        pending = list(table_docs.values())
+        for attempt in range(3):
+            conflicts = []
+            for i in range(0, len(pending), DRAIN_BATCH):
+                batch = pending[i:i + DRAIN_BATCH]
+                latest = table.get_many([doc["_id"] for doc, _ in batch])
+                writes = []
+                for doc, base in batch:
+                    write = { k: v for k, v in doc.items() if k != "_rev" }
+                    current = latest.get(doc["_id"], None)
+                    if current is not None:
+                        if base is not None:
+                            write = merge({ k: v for k, v in base.items() if k != "_rev" }, write,
+                                          { k: v for k, v in current.items() if k != "_rev" })
+                        write["_rev"] = current["_rev"]
+                    writes.append(write)
+                for item, result in zip(batch, table.bulk(writes)):
+                    if not result.get("ok", False):
+                        conflicts.append(item)
+            pending = conflicts
+            if not pending:
+                break
+        if pending:
+            logger.e("Replay", f"Dropped {len(pending)} journaled documents of table '{name}' after repeated conflicts", "")
+
+
+def unavailable(e: Exception):
+    """Check if an exception means that the database is unreachable or overloaded (and not eg. a conflict)"""
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return isinstance(e, requests.exceptions.HTTPError) and e.response is not None and e.response.status_code >= 500
+
+
+def write(table, doc: dict, base: dict = None):
+    """Write a document with `table.put`, queue it in the journal if the database is unreachable or slow
+    While the journal holds queued writes, new writes are queued as well so they are replayed in order.
+    `base` is the stored document `doc` was derived from, if given only the changed fields are replayed (see [`replay`](#replay)).
+    Returns the result of `put`, or `{"ok": True, "id": str, "rev": None, "queued": True}`. Conflicts are raised"""
+    global journal
+    if not journal.pending:
+        try:
+            return table.put(doc, timeout=WRITE_TIMEOUT)
+        except ConflictError:
+            raise
+        except Exception as e:
+            if not unavailable(e):
+                raise
+            logger.w("Write", f"Database unavailable, journaling writes: {e}")
+    if "_id" not in doc:
+        doc["_id"] = uuid.uuid4().hex
+    entry = { "table": table.name, "doc": doc }
+    if base is not None:
+        entry["base"] = base
+    journal.append(entry)
+    return { "ok": True, "id": doc["_id"], "rev": None, "queued": True }
+
+
+journal = Journal(FILENAME)
@@ -0,0 +1,87 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import time
+import hashlib
+import threading
+from cryptography.hazmat.primitives import serialization
+from core.Cache import LRUCache
+
+
+CACHE_SIZE = 4096
+"""
+Maximum amount of parsed keys kept in memory
+"""
+
+
+cache = LRUCache(CACHE_SIZE)   # (owner, kind) -> (fingerprint, parsed key)
+stats_lock = threading.Lock()
+counters = {
+    "hits": 0,
+    "misses": 0,
+    "parse-time": 0
+}
+
+
+def fingerprint(pem: str):
+    """Get the SHA-256 fingerprint of a PEM encoded key, ignoring line breaks"""
+    return hashlib.sha256(pem.replace("\n", "").replace("\r", "").encode("utf-8")).hexdigest()
+
+
+def public_key(owner: str, pem: str):
+    """Get the parsed public key `pem` of `owner` (a client id), parsing it only if the fingerprint changed"""
+    return _load(owner, "public", pem, lambda: serialization.load_pem_public_key(pem.encode("utf-8")))
+
+
+def private_key(owner: str, pem: str):
+    """Get the parsed private key `pem` of `owner`, parsing it only if the fingerprint changed"""
+    return _load(owner, "private", pem, lambda: serialization.load_pem_private_key(pem.encode("utf-8"), password=None))
+
+
+def reused():
+    """Count a key which was not parsed again because it is still installed, eg. the reply key of the MQTT connection"""
+    global counters, stats_lock
+    with stats_lock:
+        counters["hits"] += 1
+
+
+def invalidate(owner: str):
+    """Remove all parsed keys of `owner`, eg. after the client set a new public key"""
+    cache.invalidate((owner, "public"))
+    cache.invalidate((owner, "private"))
+
+
+def stats():
+    """Get the hit rate and the estimated parsing time saved by the key cache"""
+    global counters, stats_lock
+    with stats_lock:
+        total = counters["hits"] + counters["misses"]
+        avg_parse_time = counters["parse-time"] / counters["misses"] if counters["misses"] else 0
+        return {
+            "size": len(cache),
+            "hits": counters["hits"],
+            "misses": counters["misses"],
+            "hit-rate": counters["hits"] / total if total else 0,
+            "avg-parse-time": avg_parse_time,
+            "time-saved": counters["hits"] * avg_parse_time
+        }
+
+
+def _load(owner: str, kind: str, pem: str, parse):
+    global counters, stats_lock
+    fp = fingerprint(pem)
+    entry = cache.get((owner, kind), None)
+    if entry is not None and entry[0] == fp:
+        with stats_lock:
+            counters["hits"] += 1
+        return entry[1]
+    start = time.time()
+    key = parse()
+    took = time.time() - start
+    cache.set((owner, kind), (fp, key))
+    with stats_lock:
+        counters["misses"] += 1
+        counters["parse-time"] += took
+    return key
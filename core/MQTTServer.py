@@ -5,67 +5,176 @@ Copyright (c) 2021 Philipp Scheer
 
 import time
 import json
+import queue
+import threading
 import traceback
-from jarvis import MQTT, Exiter, Logger, API
+from jarvis import MQTT, Exiter, Logger
+from core.Router import API
 from core.Permissions import PRIVATE_KEY, PUBLIC_KEY, MQTT_SERVER, UNVERIFIED_ENDPOINTS
+from core.Dispatcher import Dispatcher
+import core.Session as Session
+import core.Metrics as Metrics
+import core.Keys as Keys
+import core.Trace as Trace
 from classes.Client import Client
 
 
-logger = Logger("MQTT-API")
-mqtt   = MQTT_SERVER
+WORKERS     = 8     # amount of endpoints that may run at the same time
+MAX_PENDING = 256   # amount of messages that may be queued or running before replying with a "busy" error
+MAX_REJECTED = 256  # amount of "busy" errors waiting to be published, further rejected messages get no reply
+
+
+logger       = Logger("MQTT-API")
+mqtt         = MQTT_SERVER
+publish_lock = threading.Lock()   # the public key is a property of the shared MQTT instance
+installed    = False   # fingerprint of the public key installed in `mqtt` (`None` for no key), `False` if unknown
+rejected     = queue.Queue(MAX_REJECTED)   # requests rejected by the dispatcher, answered by `reply_busy`
 
 
 def on_message(topic: str, data: any, client_id: str):
     """This function gets called whenever the MQTT server receives a message  
-    It only listens to the `jarvis/#` topic and tries to find an appropriate endpoint in the API class"""
-    global logger, mqtt
+    It only listens to the `jarvis/#` topic and hands the message to the dispatcher.  
+    Messages of the same client are handled in order, if too many messages are pending the client receives a "busy" error.
+    The error is published by [`reply_busy`](#reply_busy), publishing waits for `publish_lock` which would block all incoming messages"""
+    global logger, dispatcher, rejected
+    if not dispatcher.submit(client_id, topic, data, client_id):
+        logger.w("Busy", f"Rejecting '{topic}' from '{client_id}', {MAX_PENDING} messages pending")
+        try:
+            rejected.put_nowait(data)
+        except queue.Full:
+            pass   # the client runs into its timeout instead
+
+
+def reply_busy():
+    """Publish a "busy" error for every rejected message until Jarvis stops"""
+    global logger, rejected
+    while Exiter.running:
+        try:
+            data = rejected.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        try:
+            publish(data, { "success": False, "error": "busy" }, None)
+        except Exception:
+            logger.e("Busy", "Failed to publish busy error", traceback.format_exc())
+
+
+def publish(data: dict, res: dict, public_key: str):
+    """Encrypt `res` with `public_key` and publish it to the `reply-to` channel of the request `data`  
+    Installing a public key parses it, so the key is only installed if it differs from the installed one"""
+    global mqtt, publish_lock, installed
+    if "reply-to" not in data:
+        return False
+    fp = None if public_key is None else Keys.fingerprint(public_key)
+    with publish_lock:
+        if fp != installed:
+            mqtt.update_public_key(public_key)
+            installed = fp
+        elif fp is not None:   # no key is parsed for clients without a public key
+            Keys.reused()
+        mqtt.publish(data["reply-to"], res)
+    return True
+
+
+def execute(topic: str, client: Client, data: dict, client_id: str):
+    """Run the endpoint for `topic`, traced if a scoped trace rule matches (see `core/Trace`)  
+    Records the `endpoint` phase and returns the response `{"success": bool, "result": any}`"""
+    global logger
+    route = API.route_of(topic) or "unknown"
+    start = time.time()
+    traced = Trace.begin(route, client_id)
+    try:
+        res = API.execute(topic, client, data)
+        res = { "success": res[0], "result": res[1] }
+    except Exception:
+        logger.e("Server", f"Unknown exception occured in endpoint '{topic}'", traceback.format_exc())
+        res = { "success": False }
+    if traced:
+        Trace.end()
+    Metrics.record(route, "endpoint", time.time() - start, not res["success"])
+    return res
+
+
+def handle_message(topic: str, data: any, client_id: str):
+    """Load the client, find an appropriate endpoint in the API class and publish the result  
+    Runs on a dispatcher worker thread"""
+    global logger
 
     start = time.time()
     client = None
+    session = None
+
+    if Session.is_envelope(data):
+        session = Session.get(data["session"], client_id)
+        try:
+            if session is None:
+                raise Exception("session expired")
+            data = { "reply-to": data.get("reply-to", None), **session.decrypt(topic, data) }
+        except Exception:
+            logger.w("Session", f"Rejecting session message '{topic}' from '{client_id}', unknown or expired session")
+            publish(data, { "success": False, "error": "session-expired" }, None)
+            return
 
     logger.d("Message", f"{topic} -> {data} : {client_id}")
+    route = API.route_of(topic) or "unknown"
 
     if topic not in UNVERIFIED_ENDPOINTS:
         try:
             client = Client.load(client_id)
-            client.set("modified-at", int(time.time()))
+            now = int(time.time())
+            Client.touch(client_id, { "modified-at": now, "last-seen": now })
         except Exception:
             logger.e("Client", f"Failed to get client '{client_id}'", traceback.format_exc())
             res = { "success": False }
-            mqtt.update_public_key(None)
-            mqtt.publish(data["reply-to"], res)
+            publish(data, res, None)
+            Metrics.record(route, "total", time.time() - start, True)
             logger.d("Timing", f"Executing MQTT endpoint '{topic}' took {time.time()-start :.2f}s")
             return
+    loaded = time.time()
 
-    try:
-        res = API.execute(topic, client, data)
-        res = { "success": res[0], "result": res[1] }
-    except Exception as e:
-        logger.e("Server", f"Unknown exception occured in endpoint '{topic}'", traceback.format_exc())
+    res = execute(topic, client, data, client_id)
+    executed = time.time()
+    error = not res["success"]
 
-    if client:
+    rpub = None
+    reloaded = executed
+    if session and "reply-to" in data:
+        res = session.encrypt(data["reply-to"], res)   # symmetric, no RSA needed
+    elif client:
         client.reload()
+        reloaded = time.time()
         rpub = client.get("public-key", None)
-        mqtt.update_public_key(rpub)
-    else:
-        mqtt.update_public_key(None)
 
-    mqtt.publish(data["reply-to"], res) \
-        if "reply-to" in data else \
-            logger.w("Server", f"No 'reply-to' channel specified for topic '{topic}'")
+    if not publish(data, res, rpub):
+        logger.w("Server", f"No 'reply-to' channel specified for topic '{topic}'")
+    end = time.time()
 
-    logger.d("Timing", f"Executing MQTT endpoint '{topic}' took {time.time()-start :.2f}s")
+    Metrics.record(route, "load", (loaded - start) + (reloaded - executed))
+    Metrics.record(route, "publish", end - reloaded)
+    Metrics.record(route, "total", end - start, error)
+    logger.d("Timing", f"Executing MQTT endpoint '{topic}' took {end-start :.2f}s")
 
     # mqtt.publish takes ~4s, encryption?
 
 
+dispatcher = Dispatcher(handle_message, WORKERS, MAX_PENDING, "mqtt worker")
+
+
+def start():
+    """Start the dispatcher and listen to the `jarvis/#` topic, returns immediately"""
+    global mqtt, dispatcher
+    dispatcher.start()
+    threading.Thread(target=reply_busy, name="mqtt busy replies", daemon=True).start()
+    mqtt.on_message(on_message)
+    mqtt.subscribe("jarvis/#")
+
+
 def start_server():
     """Start the MQTT API server.  
     Create a logging instance and an MQTT server, where we start the main loop"""
-    global logger, mqtt
+    global logger
     logger.i("Start", "Starting MQTT API server")
-    mqtt.on_message(on_message)
-    mqtt.subscribe("jarvis/#")
+    start()
     Exiter.mainloop()
     logger.i("Exit", "Shutting down MQTT API server")
 
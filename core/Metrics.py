@@ -0,0 +1,136 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import bisect
+import threading
+from core.Router import API
+
+
+BUCKETS = [0.0001 * 2 ** i for i in range(21)]
+"""
+Upper bounds (in seconds) of the histogram buckets, from 0.1ms to ~105s doubling every bucket
+Percentiles are reported as the upper bound of the bucket they fall into
+"""
+
+PHASES = ["total", "load", "endpoint", "publish"]
+"""
+Phases of a request which are measured separately:
+* `total` - from receiving the message to publishing the reply
+* `load` - loading and reloading the client (`Client.load`, `Client.reload`)
+* `endpoint` - running the endpoint
+* `publish` - encrypting and publishing the reply
+"""
+
+
+class Histogram():
+    """
+    A latency histogram with fixed buckets
+    Recording a value is a bisect and a few integer additions, so it can be used on the hot path
+    """
+
+    __slots__ = ["counts", "count", "errors", "sum", "max", "lock"]
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float, error: bool = False):
+        """Record a duration of `seconds`, optionally marking it as failed"""
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+            if error:
+                self.errors += 1
+
+    def percentile(self, p: float):
+        """Get the upper bucket bound below which `p` percent of the recorded values are"""
+        if self.count == 0:
+            return 0
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    def stats(self):
+        """Get count, error count, average, maximum and p50/p90/p99"""
+        with self.lock:
+            return {
+                "count": self.count,
+                "errors": self.errors,
+                "avg": self.sum / self.count if self.count else 0,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99)
+            }
+
+
+histograms = {}  # route -> { phase: Histogram }
+histograms_lock = threading.Lock()
+counters = {}  # name -> int
+counters_lock = threading.Lock()
+
+
+def record(route: str, phase: str, seconds: float, error: bool = False):
+    """Record the duration of a `phase` (see [`PHASES`](#PHASES)) of a request to `route`"""
+    global histograms, histograms_lock
+    phases = histograms.get(route, None)
+    if phases is None:
+        with histograms_lock:
+            phases = histograms.setdefault(route, { phase: Histogram() for phase in PHASES })
+    phases[phase].record(seconds, error)
+
+
+def count(name: str, n: int = 1):
+    """Increase the counter `name` by `n`, for events which have no duration (eg. write conflicts)"""
+    global counters, counters_lock
+    with counters_lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+def stats():
+    """Get the latency statistics of all routes and phases"""
+    global histograms
+    return { route: { phase: h.stats() for phase, h in phases.items() } for route, phases in list(histograms.items()) }
+
+
+@API.route("jarvis/metrics")
+def get_metrics(args, client, data):
+    """Get latency histograms of all endpoints and event counters
+    Returns:
+    ```python
+    {
+        "buckets": [float, ...], # upper bucket bounds in seconds
+        "routes": {
+            "<route>": {
+                "<total|load|endpoint|publish>": {
+                    "count": int,
+                    "errors": int,
+                    "avg": float, # seconds
+                    "max": float,
+                    "p50": float,
+                    "p90": float,
+                    "p99": float
+                }
+            }
+        },
+        "counters": {
+            "<name>": int # eg. "client-save-conflicts"
+        }
+    }
+    ```"""
+    global counters
+    return { "buckets": BUCKETS, "routes": stats(), "counters": dict(counters) }
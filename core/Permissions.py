@@ -4,8 +4,11 @@ Copyright (c) 2021 Philipp Scheer
 
 
 import json
-from jarvis import Crypto, Config, Logger, MQTT, API
+from jarvis import Crypto, Logger, MQTT
+from core.Router import API
+from core.Config import Config
 from classes.Client import Client
+import core.Keys as Keys
 
 
 KEYLEN = 2048 # https://danielpocock.com/rsa-key-sizes-2048-or-4096-bits/
@@ -42,12 +45,14 @@ if not Client.exists(SERVER_ID):
 
 PUBLIC_KEY  = keys["public"]
 PRIVATE_KEY = keys["private"]
+Keys.public_key(SERVER_ID, PUBLIC_KEY)
+Keys.private_key(SERVER_ID, PRIVATE_KEY)
 
 cnf.set("mqtt-server-id", SERVER_ID)
 MQTT_SERVER = MQTT(SERVER_ID, PRIVATE_KEY, PUBLIC_KEY, PUBLIC_KEY)
 
 
-@API.route("jarvis/server/get/public-key")
+@API.route("jarvis/server/get/public-key", cache=True)
 def get_public_key(args, client, data):
     return PUBLIC_KEY
 
@@ -64,5 +69,18 @@ def set_public_key(args, client: Client, data):
         return True
     client.set("public-key", pub_key)
     client.save()
+    Keys.invalidate(client.id)
     return True
     return False # trying to modify client public key
+
+@API.route("jarvis/client/{id}/set/public-key")
+def set_client_public_key(args, client: Client, data):
+    """Set the public key of the client given in the topic  
+    A client may only set its own public key, the server may set the key of any client"""
+    global logger
+    if args["id"] != client.id and not client.get("is-root", False):
+        logger.w("Public-Key", f"Client '{client.id}' tried to set the public key of client '{args['id']}'")
+        return False
+    if args["id"] != client.id:
+        client = Client.load(args["id"])
+    return set_public_key(args, client, data)
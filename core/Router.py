@@ -0,0 +1,184 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import threading
+from core.Cache import LRUCache
+
+
+MEMO_SIZE = 4096
+"""
+Amount of resolved topics to remember, topics with parameters (eg. client ids) are remembered individually
+"""
+
+RESPONSE_CACHE_SIZE = 1024
+"""
+Amount of responses to remember per cached endpoint
+"""
+
+MISSING = object()   # marker for uncached responses, endpoints may return None
+
+
+class Node():
+    """
+    A node of the topic trie, one node per topic segment
+    """
+
+    __slots__ = ["children", "param", "param_name", "rest", "rest_name", "handler"]
+
+    def __init__(self) -> None:
+        self.children = {}      # literal segment -> Node
+        self.param = None       # Node for a `{name}` segment
+        self.param_name = None
+        self.rest = None        # handler for a trailing `#` or `{name...}` segment
+        self.rest_name = None
+        self.handler = None
+
+
+class API():
+    """
+    Registers MQTT endpoints and resolves topics to endpoints using a topic trie
+    Drop-in replacement for `jarvis.API`: decorate endpoints with `@API.route(topic)` and call them with `API.execute(topic, client, data)`
+
+    Topic segments can be:
+    * literals: `jarvis/status`
+    * named parameters matching exactly one segment: `jarvis/client/{id}/set/public-key`
+    * a trailing parameter matching all remaining segments: `jarvis/app/{path...}` or `jarvis/app/#` (as `args["#"]`)
+
+    Endpoints are called as `fn(args, client, data)` where `args` is a dict of the matched parameters.
+    Literal segments take precedence over parameters. Resolved topics are memoized, so the dispatch cost does not depend on the amount of routes.
+
+    Read-only endpoints can cache their responses per topic (and optionally per client) with `@API.route(topic, cache=True, ttl=seconds)`,
+    the request data is not part of the cache key. Writers invalidate cached responses with [`API.invalidate(topic)`](#invalidate)
+    """
+
+    root = Node()
+    memo = LRUCache(MEMO_SIZE)
+    lock = threading.Lock()
+    responses = {}  # endpoint -> (route topic, per_client, LRUCache)
+    topics = {}     # endpoint -> route topic
+
+    @staticmethod
+    def route(topic: str, cache: bool = False, ttl: float = None, per_client: bool = False):
+        """Decorator to register a function as endpoint for `topic`  
+        If `cache` is set, responses are cached for `ttl` seconds (`None` = until invalidated), separately for every client if `per_client` is set"""
+        def decorator(fn):
+            API.register(topic, fn, cache, ttl, per_client)
+            return fn
+        return decorator
+
+    @staticmethod
+    def register(topic: str, fn, cache: bool = False, ttl: float = None, per_client: bool = False):
+        """Register `fn` as endpoint for `topic`, replaces an existing endpoint with the same topic"""
+        with API.lock:
+            API.topics[fn] = topic
+            if cache:
+                API.responses[fn] = (topic, per_client, LRUCache(RESPONSE_CACHE_SIZE, ttl))
+            node = API.root
+            segments = topic.split("/")
+            for i, segment in enumerate(segments):
+                if segment == "#" or (segment.startswith("{") and segment.endswith("...}")):
+                    assert i == len(segments) - 1, f"'{segment}' has to be the last segment of topic '{topic}'"
+                    node.rest = fn
+                    node.rest_name = "#" if segment == "#" else segment[1:-4]
+                    break
+                if segment.startswith("{") and segment.endswith("}"):
+                    name = segment[1:-1]
+                    if node.param is None:
+                        node.param = Node()
+                        node.param_name = name
+                    assert node.param_name == name, f"Conflicting parameter names '{node.param_name}' and '{name}' in topic '{topic}'"
+                    node = node.param
+                else:
+                    node = node.children.setdefault(segment, Node())
+            else:
+                node.handler = fn
+            API.memo.clear()
+
+    @staticmethod
+    def resolve(topic: str):
+        """Find the endpoint for `topic`
+        Returns a tuple `(fn, args)` or `(None, None)` if no endpoint matches"""
+        match = API.memo.get(topic, None)
+        if match is None:
+            match = API._match(API.root, topic.split("/"), 0)
+            match = match if match is not None else (None, None)
+            API.memo.set(topic, match)
+        return match
+
+    @staticmethod
+    def execute(topic: str, client, data: dict):
+        """Execute the endpoint for `topic`
+        Returns a tuple `(success, result)`"""
+        fn, args = API.resolve(topic)
+        if fn is None:
+            return (False, f"No endpoint found for topic '{topic}'")
+        cached = API.responses.get(fn, None)
+        if cached is None:
+            return (True, fn(dict(args), client, data))
+        _, per_client, responses = cached
+        key = (topic, client.id if per_client and client is not None else None)
+        result = responses.get(key, MISSING)
+        if result is MISSING:
+            result = fn(dict(args), client, data)
+            responses.set(key, result)
+        return (True, result)
+
+    @staticmethod
+    def route_of(topic: str):
+        """Get the registered route of `topic` (eg. `jarvis/client/{id}/set/public-key`), `None` if no endpoint matches"""
+        fn, _ = API.resolve(topic)
+        return API.topics.get(fn, None)
+
+    @staticmethod
+    def invalidate(topic: str):
+        """Remove all cached responses of the endpoint for `topic` (for all clients)  
+        Returns `False` if the endpoint does not cache responses"""
+        fn, _ = API.resolve(topic)
+        cached = API.responses.get(fn, None)
+        if cached is None:
+            return False
+        cached[2].clear()
+        return True
+
+    @staticmethod
+    def cache_stats():
+        """Get the response cache counters of all cached endpoints"""
+        return { topic: responses.stats() for topic, _, responses in API.responses.values() }
+
+    @staticmethod
+    def routes():
+        """List all registered topics"""
+        result = []
+        def walk(node, prefix):
+            if node.handler is not None:
+                result.append("/".join(prefix))
+            if node.rest is not None:
+                result.append("/".join(prefix + ["#" if node.rest_name == "#" else f"{{{node.rest_name}...}}"]))
+            for segment, child in node.children.items():
+                walk(child, prefix + [segment])
+            if node.param is not None:
+                walk(node.param, prefix + [f"{{{node.param_name}}}"])
+        walk(API.root, [])
+        return result
+
+    @staticmethod
+    def _match(node: Node, segments: list, i: int):
+        """Match `segments[i:]` starting at `node`, literals first, then parameters, then trailing parameters"""
+        if i == len(segments):
+            if node.handler is not None:
+                return (node.handler, {})
+            return None
+        child = node.children.get(segments[i], None)
+        if child is not None:
+            match = API._match(child, segments, i + 1)
+            if match is not None:
+                return match
+        if node.param is not None and segments[i] != "":
+            match = API._match(node.param, segments, i + 1)
+            if match is not None:
+                return (match[0], {node.param_name: segments[i], **match[1]})
+        if node.rest is not None:
+            return (node.rest, {node.rest_name: "/".join(segments[i:])})
+        return None
@@ -3,19 +3,27 @@ Copyright (c) 2021 Philipp Scheer
 """
 
 
-from jarvis import API
+import time
+from concurrent.futures import ThreadPoolExecutor
+from jarvis import Logger
+from core.Router import API
 from classes.Client import Client
+from classes.Token import Token, TOKEN_EXPIRATION_SECONDS
+
+
+MAX_BATCH_SIZE = 32     # maximum amount of endpoint calls in one batch
+BATCH_WORKERS  = 4      # maximum amount of batch items running in parallel
+
+
+logger = Logger("Routing")
+batch_executor = ThreadPoolExecutor(BATCH_WORKERS, "batch")
 
 
 @API.route("jarvis/client/set")
 def set_value(args: list, client: Client, data: dict):
     if not "key" in data or not "value" in data:
         return False
-    key   = data["key"]
-    value = data["value"]
-    data  = client.get("data", {})
-    data[key] = value
-    client.set("data", data)
+    client.set_data(data["key"], data["value"])
     client.save()
     return True
 
@@ -25,3 +33,85 @@ def set_client_info(args: list, client: Client, data: dict):
         client.set("device", data["device"])
     return True
 
+
+@API.route("jarvis/client/list")
+def list_clients(args: list, client: Client, data: dict):
+    """List clients, optionally filtered by indexed fields. Only root clients may list clients. Request:
+    ```python
+    {
+        "device": str, # optional, eg. "phone"
+        "activated": bool, # optional
+        "secure": bool, # optional
+        "seen-since": int, # optional, unix timestamp
+        "limit": int, # optional, default 100, at most 1000
+        "bookmark": str # optional, bookmark of the previous page
+    }
+    ```
+    Returns `{ "clients": [ { "id": str, "name": str, "device": str, "activated": bool, "secure": bool, "last-seen": int } ], "bookmark": str }`"""
+    if not client.get("is-root", False):
+        return False
+    clients, bookmark = Client.query(data.get("device", None), data.get("activated", None), data.get("secure", None),
+                                     data.get("seen-since", None), min(int(data.get("limit", 100)), 1000), data.get("bookmark", None))
+    return {
+        "clients": [{ "id": c.id, **{ k: c.get(k, None) for k in ["name", "device", "activated", "secure", "last-seen"] } } for c in clients],
+        "bookmark": bookmark
+    }
+
+
+@API.route("jarvis/token/issue")
+def issue_tokens(args: list, client: Client, data: dict):
+    """Issue multiple registration tokens at once, eg. to provision a batch of devices. Only root clients may issue tokens. Request:
+    ```python
+    {
+        "count": int, # at most MAX_ISSUE
+        "permission": int,
+        "expires-in": int, # optional, seconds, default TOKEN_EXPIRATION_SECONDS
+        "format": "csv"|"json" # optional, default "json"
+    }
+    ```
+    Returns the export of the issued tokens as string, see `Token.export`"""
+    if not client.get("is-root", False) or "count" not in data or "permission" not in data:
+        return False
+    tokens = Token.new_many(int(data["count"]), int(data["permission"]), int(data.get("expires-in", TOKEN_EXPIRATION_SECONDS)))
+    return "".join(Token.export(tokens, data.get("format", "json")))
+
+
+@API.route("jarvis/batch")
+def batch(args: list, client: Client, data: dict):
+    """Execute multiple endpoints with one message  
+    The client is loaded and the response is encrypted and published only once.
+    Set `parallel` to run independent items at the same time, items which modify the client should not run in parallel.  
+    Request:
+    ```python
+    {
+        "items": [ { "topic": str, "data": dict }, ... ], # at most MAX_BATCH_SIZE items
+        "parallel": true|false
+    }
+    ```
+    Returns a list with one entry per item, in the same order:
+    ```python
+    [ { "success": true|false, "result": any, "took": float # seconds }, ... ]
+    ```"""
+    global logger, batch_executor
+    import core.MQTTServer as MQTTServer
+    items = data.get("items", None)
+    if not isinstance(items, list) or len(items) > MAX_BATCH_SIZE:
+        return {"success": False, "error": f"Provide a list of at most {MAX_BATCH_SIZE} items"}
+
+    def run(item):
+        start = time.time()
+        topic = item.get("topic", None) if isinstance(item, dict) else None
+        if topic == "jarvis/batch":
+            logger.e("Batch", "Batches cannot be nested")
+            res = { "success": False }
+        else:
+            item_data = item.get("data", {}) if isinstance(item, dict) else {}
+            if isinstance(item_data, dict) and "reply-to" in data and "reply-to" not in item_data:
+                item_data = { **item_data, "reply-to": data["reply-to"] }
+            res = MQTTServer.execute(topic, client, item_data, client.id if client else None)
+        res["took"] = time.time() - start
+        return res
+
+    if data.get("parallel", False):
+        return list(batch_executor.map(run, items))
+    return [run(item) for item in items]
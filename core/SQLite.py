@@ -0,0 +1,239 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import os
+import json
+import uuid
+import sqlite3
+import threading
+from core.Couch import ConflictError
+
+
+FILENAME = os.environ.get("JARVIS_DATABASE_FILE", f"{os.path.dirname(os.path.abspath(__file__))}/../../data/jarvis.sqlite")
+"""
+SQLite database file holding the documents of all tables, set `JARVIS_DATABASE_FILE` to change it
+"""
+
+OPERATORS = { "$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<=" }
+"""
+Mango operators which are translated into SQL, besides `$exists`, `$in`, `$and` and `$or`
+"""
+
+
+local = threading.local()   # one connection per thread
+write_lock = threading.RLock()
+changed = threading.Condition(write_lock)   # notified after every write, wakes up waiting `changes` calls
+
+
+def connection():
+    """Get the connection of the current thread, creates the database on first use"""
+    global FILENAME, local
+    db = getattr(local, "db", None)
+    if db is None:
+        os.makedirs(os.path.dirname(os.path.abspath(FILENAME)), exist_ok=True)
+        db = sqlite3.connect(FILENAME, timeout=30, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS docs (tbl TEXT NOT NULL, id TEXT NOT NULL, rev INTEGER NOT NULL, "
+                   "seq INTEGER NOT NULL, deleted INTEGER NOT NULL DEFAULT 0, doc TEXT NOT NULL, PRIMARY KEY (tbl, id))")
+        db.execute("CREATE INDEX IF NOT EXISTS docs_seq ON docs (tbl, seq)")
+        db.execute("CREATE INDEX IF NOT EXISTS docs_last_seq ON docs (seq)")
+        local.db = db
+    return db
+
+
+def last_seq(db):
+    """Get the last sequence number of all tables  
+    Sequence numbers are assigned within the write transaction, so they are unique even if multiple processes write the file"""
+    return db.execute("SELECT COALESCE(MAX(seq), 0) FROM docs").fetchone()[0]
+
+
+def up():
+    """Check if the database file can be opened and written"""
+    try:
+        connection().execute("BEGIN IMMEDIATE")
+        connection().execute("ROLLBACK")
+        return True
+    except Exception:
+        return False
+
+
+def path(field: str):
+    """JSON path of a (dot separated) document field, eg. `data.name` -> `$."data"."name"`"""
+    assert '"' not in field and "'" not in field, f"Invalid field name '{field}'"
+    return "$" + "".join(f'."{part}"' for part in field.split("."))
+
+
+def column(field: str):
+    """SQL expression of a document field, indexes are created on the same expressions"""
+    return "id" if field == "_id" else f"json_extract(doc, '{path(field)}')"
+
+
+def where(selector: dict):
+    """Translate a Mango selector into a SQL condition, returns a tuple `(sql, params)`"""
+    clauses, params = [], []
+    for field, condition in selector.items():
+        if field in ["$and", "$or"]:
+            parts = [where(sub) for sub in condition]
+            clauses.append("(" + (" AND " if field == "$and" else " OR ").join(p[0] for p in parts) + ")" if parts else "1")
+            params += [p for part in parts for p in part[1]]
+            continue
+        if not isinstance(condition, dict):
+            condition = { "$eq": condition }
+        for op, value in condition.items():
+            if op == "$exists":
+                clauses.append(f"json_type(doc, '{path(field)}') IS {'NOT ' if value else ''}NULL")
+            elif op == "$in":
+                clauses.append(f"{column(field)} IN ({', '.join('?' * len(value))})" if value else "0")
+                params += list(value)
+            elif op not in OPERATORS:
+                raise Exception(f"Unsupported selector operator '{op}'")
+            elif value is None:   # null sorts before every other value
+                clauses.append({ "$eq": f"json_type(doc, '{path(field)}') = 'null'", "$ne": f"json_type(doc, '{path(field)}') != 'null'",
+                                 "$gt": "1", "$gte": "1", "$lt": "0", "$lte": "0" }[op])
+            else:
+                clauses.append(f"{column(field)} {OPERATORS[op]} ?")
+                params.append(json.dumps(value) if isinstance(value, (dict, list)) else value)
+    return (" AND ".join(clauses) or "1", params)
+
+
+class Table():
+    """
+    A table stored in SQLite with the interface of [`core/Couch.Table`](core/Couch#Table)
+    Documents are stored as JSON, revisions are numbered like CouchDB revisions (`<n>-<hash>`) and writes with an outdated
+    revision raise a `ConflictError`. Deleted documents are kept as tombstones so the `_changes` feed can report them
+    """
+
+    def __init__(self, name: str) -> None:
+        """Initialize a handle for the table `name`"""
+        self.name = name
+
+    def get(self, id: str):
+        """Get the latest revision of the document `id`, `None` if it does not exist"""
+        row = connection().execute("SELECT doc FROM docs WHERE tbl = ? AND id = ? AND NOT deleted", (self.name, id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, doc: dict, timeout: float = None):
+        """Insert or update a single document, a document without `_id` gets a random id (`timeout` is ignored)
+        Returns `{"ok": True, "id": str, "rev": str}`, raises a `ConflictError` if `doc["_rev"]` is outdated"""
+        db = connection()
+        with changed:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = self._write(db, doc, last_seq(db) + 1)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            changed.notify_all()
+        return result
+
+    def get_many(self, ids: list):
+        """Get the documents with the given `ids`, returns a dict of id -> document, missing documents are left out"""
+        ids = list(ids)
+        result = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = connection().execute(f"SELECT id, doc FROM docs WHERE tbl = ? AND NOT deleted AND id IN ({', '.join('?' * len(chunk))})",
+                                        [self.name] + chunk)
+            result.update({ id: json.loads(doc) for id, doc in rows })
+        return result
+
+    def all_docs(self, limit: int, startkey: str = None, skip: int = 0):
+        """Get up to `limit` documents ordered by id, starting at id `startkey`"""
+        rows = connection().execute("SELECT doc FROM docs WHERE tbl = ? AND NOT deleted AND id >= ? ORDER BY id LIMIT ? OFFSET ?",
+                                    (self.name, startkey or "", limit, skip))
+        return [json.loads(doc) for doc, in rows]
+
+    def find(self, selector: dict, limit: int = 25, bookmark: str = None, sort: list = None, fields: list = None):
+        """Run a Mango query (see [`where`](#where) for the supported operators)
+        Returns a tuple `(documents, bookmark)`, pass the bookmark to get the next page"""
+        condition, params = where(selector)
+        order = "id"
+        if sort:
+            order = ", ".join(f"{column(s)} ASC" if isinstance(s, str) else
+                              ", ".join(f"{column(f)} {'DESC' if d == 'desc' else 'ASC'}" for f, d in s.items()) for s in sort)
+        offset = int(bookmark or 0)
+        rows = connection().execute(f"SELECT doc FROM docs WHERE tbl = ? AND NOT deleted AND {condition} ORDER BY {order} LIMIT ? OFFSET ?",
+                                    [self.name] + params + [limit, offset]).fetchall()
+        docs = [json.loads(doc) for doc, in rows]
+        if fields is not None:
+            docs = [{ f: d[f] for f in fields if f in d } for d in docs]
+        return (docs, str(offset + len(docs)))
+
+    def bulk(self, docs: list):
+        """Insert or update `docs` in one transaction
+        Returns a list of `{"id": str, "rev": str, "ok": True}` or `{"id": str, "error": "conflict", "reason": str}` in the same order as `docs`"""
+        results = []
+        db = connection()
+        with changed:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                seq = last_seq(db)
+                for doc in docs:
+                    try:
+                        results.append(self._write(db, doc, seq + 1))
+                        seq += 1
+                    except ConflictError as e:
+                        results.append({ "id": doc.get("_id", None), "error": "conflict", "reason": str(e) })
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            changed.notify_all()
+        return results
+
+    def create_index(self, name: str, fields: list):
+        """Create an index `name` on `fields` if it does not exist yet
+        Returns `True` if the index was created, `False` if it already existed"""
+        index = f"{self.name}-{name}".replace('"', "")
+        db = connection()
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index,)).fetchone():
+            return False
+        db.execute(f"CREATE INDEX \"{index}\" ON docs (tbl, {', '.join(column(f) for f in fields)})")
+        return True
+
+    def changes(self, since: str = "now", timeout: int = 30, include_docs: bool = False):
+        """Wait up to `timeout` seconds for changes after sequence `since`, see [`core/Couch.Table.changes`](core/Couch#changes)
+        Only writes of this process wake up a waiting call early. The returned sequence is the latest one of all tables,
+        so writes to other tables are not reported again by the next call"""
+        db = connection()
+        with changed:
+            current = last_seq(db)
+            if since == "now":
+                since = current
+            since = int(since)
+            if current <= since:
+                changed.wait(timeout)
+                current = last_seq(db)
+        rows = db.execute("SELECT id, rev, seq, deleted, doc FROM docs WHERE tbl = ? AND seq > ? AND seq <= ? ORDER BY seq",
+                          (self.name, since, current)).fetchall()
+        results = []
+        for id, rev, s, deleted, doc in rows:
+            change = { "id": id, "seq": s, "changes": [{ "rev": json.loads(doc)["_rev"] }] }
+            if deleted:
+                change["deleted"] = True
+            if include_docs:
+                change["doc"] = json.loads(doc)
+            results.append(change)
+        return (results, max(current, since))   # the sequence is shared by all tables, skip writes to other tables
+
+    def _write(self, db, doc: dict, seq: int):
+        """Write a document with sequence number `seq` within a transaction, the caller holds the write lock"""
+        id = doc.get("_id", None) or uuid.uuid4().hex
+        row = db.execute("SELECT rev, deleted, doc FROM docs WHERE tbl = ? AND id = ?", (self.name, id)).fetchone()
+        current = json.loads(row[2])["_rev"] if row and not row[1] else None
+        if doc.get("_rev", None) != current:
+            raise ConflictError(f"Document '{id}' was changed since revision '{doc.get('_rev', None)}'")
+        rev = (row[0] if row else 0) + 1
+        deleted = bool(doc.get("_deleted", False))
+        stored = { "_id": id, "_rev": f"{rev}-{uuid.uuid4().hex}" }
+        if deleted:
+            stored["_deleted"] = True
+        else:
+            stored.update({ k: v for k, v in doc.items() if k not in ["_id", "_rev"] })
+        db.execute("INSERT OR REPLACE INTO docs (tbl, id, rev, seq, deleted, doc) VALUES (?, ?, ?, ?, ?, ?)",
+                   (self.name, id, rev, seq, int(deleted), json.dumps(stored)))
+        return { "ok": True, "id": id, "rev": stored["_rev"] }
@@ -0,0 +1,182 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import os
+import json
+import time
+import base64
+import secrets
+import threading
+from jarvis import Logger
+from core.Router import API
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from core.Permissions import PRIVATE_KEY, SERVER_ID
+import core.Keys as Keys
+from classes.Client import Client
+
+
+SESSION_TTL = 60 * 60
+"""
+Seconds a session key is valid, afterwards the client has to start a new session
+"""
+
+SESSION_MAX_MESSAGES = 2 ** 20
+"""
+Amount of messages (in both directions) a session key may encrypt before the client has to start a new session
+Nonces are random, so this keeps the chance of a nonce collision negligible
+"""
+
+NONCE_LENGTH = 12
+
+
+logger = Logger("Session")
+sessions = {}   # session id -> Session
+sessions_lock = threading.Lock()
+
+
+class Session():
+    """
+    A symmetric session between a client and the server
+    The key is exchanged once with RSA ([`jarvis/session/start`](#start_session)), afterwards messages are encrypted with AES-GCM.
+    Every envelope carries a sequence number which is part of the associated data and has to increase, so captured envelopes cannot be replayed
+    """
+
+    def __init__(self, client_id: str) -> None:
+        """Create a new session with a random 256 bit key for the client `client_id`"""
+        self.id = secrets.token_hex(16)
+        self.client_id = client_id
+        self.key = AESGCM.generate_key(bit_length=256)
+        self.aead = AESGCM(self.key)
+        self.created_at = int(time.time())
+        self.expires_at = self.created_at + SESSION_TTL
+        self.messages = 0
+        self.sent = 0   # sequence number of the last envelope sent to the client
+        self.received = 0   # sequence number of the last envelope accepted from the client
+        self._lock = threading.Lock()
+
+    @property
+    def expired(self):
+        return self.expires_at < time.time() or self.messages >= SESSION_MAX_MESSAGES
+
+    def encrypt(self, topic: str, message: any):
+        """Encrypt the JSON serializable `message` bound to `topic`, returns a session envelope"""
+        with self._lock:
+            self.messages += 1
+            self.sent += 1
+            seq = self.sent
+        nonce = os.urandom(NONCE_LENGTH)
+        ciphertext = self.aead.encrypt(nonce, json.dumps(message).encode("utf-8"), self._aad(topic, seq))
+        return {
+            "session": self.id,
+            "seq": seq,
+            "nonce": base64.b64encode(nonce).decode("ascii"),
+            "ciphertext": base64.b64encode(ciphertext).decode("ascii"),
+            "expires-at": self.expires_at
+        }
+
+    def decrypt(self, topic: str, envelope: dict):
+        """Decrypt a session envelope that was sent to `topic`  
+        Raises an exception if the envelope was tampered with or its sequence number is not higher than the last accepted one (replay)"""
+        seq = int(envelope["seq"])
+        nonce = base64.b64decode(envelope["nonce"])
+        ciphertext = base64.b64decode(envelope["ciphertext"])
+        with self._lock:
+            if seq <= self.received:
+                raise Exception(f"Replayed envelope {seq}, last accepted {self.received}")
+            plaintext = self.aead.decrypt(nonce, ciphertext, self._aad(topic, seq))
+            self.received = seq
+            self.messages += 1
+        return json.loads(plaintext.decode("utf-8"))
+
+    def wrap_key(self, public_key: str):
+        """Encrypt the session key with the RSA `public_key` of the client (OAEP, SHA-256)"""
+        public_key = Keys.public_key(self.client_id, public_key)
+        return public_key.encrypt(self.key, padding.OAEP(mgf=padding.MGF1(hashes.SHA256()), algorithm=hashes.SHA256(), label=None))
+
+    def _aad(self, topic: str, seq: int):
+        return f"{self.id}:{self.client_id}:{topic}:{seq}".encode("utf-8")
+
+
+def is_envelope(data: any):
+    """Check if a received message is encrypted with a session key"""
+    return isinstance(data, dict) and "session" in data and "ciphertext" in data and "nonce" in data
+
+
+def get(session_id: str, client_id: str):
+    """Get an active session of `client_id`, returns `None` if the session does not exist or expired"""
+    global sessions, sessions_lock
+    with sessions_lock:
+        session = sessions.get(session_id, None)
+        if session is None or session.client_id != client_id:
+            return None
+        if session.expired:
+            del sessions[session_id]
+            return None
+        return session
+
+
+def start(client_id: str):
+    """Start a new session for `client_id`, ending all other sessions of the client (rekeying)"""
+    global sessions, sessions_lock
+    session = Session(client_id)
+    with sessions_lock:
+        for sid in [sid for sid, s in sessions.items() if s.client_id == client_id or s.expired]:
+            del sessions[sid]
+        sessions[session.id] = session
+    return session
+
+
+def end(client_id: str):
+    """End all sessions of `client_id`"""
+    global sessions, sessions_lock
+    with sessions_lock:
+        for sid in [sid for sid, s in sessions.items() if s.client_id == client_id]:
+            del sessions[sid]
+
+
+def sign(message: bytes):
+    """Sign `message` with the server private key (PSS, SHA-256)"""
+    private_key = Keys.private_key(SERVER_ID, PRIVATE_KEY)
+    return private_key.sign(message, padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH), hashes.SHA256())
+
+
+@API.route("jarvis/session/start")
+def start_session(args, client: Client, data):
+    """Start (or renew) a session
+    The session key is encrypted with the public key of the client and signed by the server.
+    All following messages may be sent as session envelopes `{"session": str, "seq": int, "nonce": base64, "ciphertext": base64}`
+    where `ciphertext` is the AES-GCM encrypted JSON message and the associated data is `"<session>:<client id>:<topic>:<seq>"`.
+    `seq` starts at 1 and has to increase with every message, envelopes with a lower or repeated `seq` are rejected.
+    Replies carry their own increasing `seq`, clients should reject replies which do not increase as well
+    Returns:
+    ```python
+    {
+        "session": str, # session id
+        "key": str, # base64, RSA-OAEP (SHA-256) encrypted 256 bit AES-GCM key
+        "signature": str, # base64, RSA-PSS (SHA-256) signature of "<session>" + key bytes
+        "expires-at": int # unix timestamp, start a new session before
+    }
+    ```"""
+    global logger
+    public_key = client.get("public-key", None)
+    if public_key is None:
+        return {"success": False, "error": "Set a public key before starting a session"}
+    session = start(client.id)
+    wrapped = session.wrap_key(public_key)
+    logger.i("Start", f"Started session for client '{client.id}'")
+    return {
+        "session": session.id,
+        "key": base64.b64encode(wrapped).decode("ascii"),
+        "signature": base64.b64encode(sign(session.id.encode("ascii") + wrapped)).decode("ascii"),
+        "expires-at": session.expires_at
+    }
+
+@API.route("jarvis/session/end")
+def end_session(args, client: Client, data):
+    """End all sessions of the client, following messages have to be encrypted with RSA again"""
+    end(client.id)
+    return True
@@ -0,0 +1,164 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import time
+import heapq
+import threading
+import traceback
+from jarvis import Logger, Exiter
+import core.Couch as Couch
+import core.Changes as Changes
+
+
+PURGE_INTERVAL = 60   # seconds between two purges of expired tokens from the database
+PURGE_BATCH = 500   # amount of expired tokens deleted per bulk request
+
+
+logger = Logger("TokenStore")
+
+
+class TokenStore():
+    """
+    Keeps all live tokens of a table in memory, documents are keyed by their token value (`_id`)
+    Tokens are evicted from memory in order of their `expires-at` using a min-heap,
+    expired documents are deleted from the database in batches by [`loop`](#loop).
+    The store follows the `_changes` feed of the table, so tokens written by others (eg. redemptions) are seen as well
+    """
+
+    def __init__(self, table: str, purge_interval: float = PURGE_INTERVAL) -> None:
+        """Initialize a store for `table` which purges expired tokens every `purge_interval` seconds"""
+        self.table = table
+        self.purge_interval = purge_interval
+        self.loaded = False
+        self.subscribed = False
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.purged = 0
+        self._tokens = {}  # token -> document
+        self._heap = []  # (expires-at, token), may contain outdated entries of re-added tokens
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load all live tokens from the database and follow the changes of the table
+        Afterwards the store is authoritative: tokens not in memory do not exist or are expired"""
+        if not self.subscribed:   # before loading, so no change gets lost
+            Changes.subscribe(self.table, self.on_change, include_docs=True)
+            self.subscribed = True
+        table = Couch.table(self.table)
+        now = time.time()
+        bookmark = None
+        while True:
+            docs, bookmark = table.find({ "expires-at": { "$gt": now } }, PURGE_BATCH, bookmark)
+            for doc in docs:
+                self.add(doc)
+            if len(docs) < PURGE_BATCH:
+                break
+        self.loaded = True
+
+    def add(self, doc: dict):
+        """Add or replace a token document, it has to contain `_id` and `expires-at`"""
+        with self._lock:
+            self._add(doc)
+
+    def add_many(self, docs: list):
+        """Add or replace multiple token documents at once"""
+        with self._lock:
+            for doc in docs:
+                self._tokens[doc["_id"]] = doc
+                self._heap.append((doc["expires-at"], doc["_id"]))
+            heapq.heapify(self._heap)
+
+    def on_change(self, change: dict):
+        """Apply a change of the table, `change` is a result of the `_changes` feed with `include_docs`  
+        Deleted and expired tokens are removed, changes we already know (same `_rev`) are skipped"""
+        doc = change.get("doc", None)
+        if change.get("deleted", False) or doc is None or doc.get("expires-at", 0) <= time.time():
+            with self._lock:
+                self._tokens.pop(change["id"], None)
+            return
+        with self._lock:   # evict() could remove the token between the lookup and the add
+            current = self._tokens.get(doc["_id"], None)
+            if current is None or current.get("_rev", None) != doc["_rev"]:
+                self._add(doc)
+
+    def _add(self, doc: dict):
+        self._tokens[doc["_id"]] = doc
+        heapq.heappush(self._heap, (doc["expires-at"], doc["_id"]))
+
+    def contains(self, token: str):
+        """Check if `token` is in memory, without a database lookup and without counting a hit or miss"""
+        return token in self._tokens
+
+    def get(self, token: str):
+        """Get the document of a live token, `None` if the token does not exist or expired
+        Until the store is [`load`](#load)ed, unknown tokens are looked up in the database"""
+        self.evict()
+        doc = self._tokens.get(token, None)
+        if doc is not None:
+            self.hits += 1
+            return doc
+        self.misses += 1
+        if not self.loaded:
+            doc = Couch.table(self.table).get(token)
+            if doc is not None and doc["expires-at"] > time.time():
+                self.add(doc)
+                return doc
+        return None
+
+    def evict(self):
+        """Remove expired tokens from memory, only looks at the heap top so this is cheap if nothing expired"""
+        now = time.time()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, token = heapq.heappop(self._heap)
+                doc = self._tokens.get(token, None)
+                if doc is not None and doc["expires-at"] <= now:   # re-added tokens can have a later expiry
+                    del self._tokens[token]
+                    self.evicted += 1
+
+    def purge(self):
+        """Delete expired tokens from the database in batches of `PURGE_BATCH`
+        Returns the amount of deleted documents"""
+        table = Couch.table(self.table)
+        deleted = 0
+        while True:
+            docs, _ = table.find({ "expires-at": { "$lte": time.time() } }, PURGE_BATCH, fields=["_id", "_rev"])
+            if not docs:
+                break
+            results = table.bulk([{ **doc, "_deleted": True } for doc in docs])
+            deleted += sum(1 for r in results if r.get("ok", False))
+            if len(docs) < PURGE_BATCH:
+                break
+        self.purged += deleted
+        return deleted
+
+    def loop(self):
+        """Load the live tokens, then evict and purge expired tokens every `purge_interval` seconds until Jarvis stops"""
+        global logger
+        while Exiter.running:
+            try:
+                if not self.loaded:
+                    self.load()
+                self.evict()
+                self.purge()
+            except Exception:
+                logger.e("Purge", f"Failed to purge expired tokens of table '{self.table}'", traceback.format_exc())
+            for i in range(int(self.purge_interval * 2)):
+                if not Exiter.running:
+                    break
+                time.sleep(0.49)
+
+    def stats(self):
+        """Get store counters"""
+        with self._lock:
+            return {
+                "live": len(self._tokens),
+                "loaded": self.loaded,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted,
+                "purged": self.purged
+            }
@@ -6,17 +6,238 @@ Copyright (c) 2021 Philipp Scheer
 import os
 import sys
 import time
-import shutil
+import reprlib
+import threading
+from core.TraceWriter import TraceWriter
+from core.Router import API
 
 
-FILENAME = f"{os.path.dirname(os.path.abspath(sys.argv[0]))}/../logs/trace.log"   # specify trace file
-FILE = open(FILENAME, "a+")   # open trace file
-MAX_ALLOWED_FILE_SIZE = 1024 * 1024 * 100   # in bytes, so 100 MB
+LOGS = f"{os.path.dirname(os.path.abspath(__file__))}/../../logs"   # anchored to this file, so jarvisd and `python3 -m core.TraceQuery` use the same directory
+DIRECTORY = f"{LOGS}/trace"   # directory of the binary trace segments, see core/TraceWriter
 ONLY_JARVIS = True   # only trace jarvis functions and files
 
+REPR = reprlib.Repr()
+"""
+Limits the size of captured arguments and return values, locals can hold multi-MB NLU datasets
+"""
+REPR.maxstring = 120
+REPR.maxother = 120
+REPR.maxlist = REPR.maxtuple = REPR.maxset = REPR.maxdict = 8
+REPR.maxlevel = 3
+
+writer = None   # TraceWriter, created when full tracing starts
+overhead = {
+    "events": 0,
+    "time": 0
+}
+
+MODES = ["off", "sample", "full"]
+"""
+Tracing modes:
+* `off` - no tracing
+* `sample` - periodically capture the stacks of all threads and aggregate them into collapsed stacks (flame graph input)
+* `full` - trace every call, return and exception of every thread with `sys.settrace` (slow)
+"""
+MODE = "off"
+
+SAMPLES_FILENAME = f"{LOGS}/trace.collapsed"   # collapsed stacks, one "frame;frame;frame count" per line
+SAMPLE_INTERVAL = 0.05   # seconds between two stack samples
+SAMPLE_WRITE_INTERVAL = 60   # seconds between two writes of the collapsed stacks file
+
+SCOPED_DURATION = 60 * 5   # default seconds a scoped trace rule stays active
+rules = []   # scoped trace rules, see `jarvis/debug/trace`
+rules_lock = threading.Lock()
+scoped = threading.local()   # `scoped.active` is set while the current thread handles a request matching a rule
+
+
+class Sampler():
+    """
+    A statistical profiler which captures the stacks of all threads every `interval` seconds
+    Stacks are aggregated in memory and written in the collapsed format used by `flamegraph.pl` and speedscope
+    """
+
+    def __init__(self, filename: str, interval: float = SAMPLE_INTERVAL, write_interval: float = SAMPLE_WRITE_INTERVAL) -> None:
+        self.filename = filename
+        self.interval = interval
+        self.write_interval = write_interval
+        self.stacks = {}  # collapsed stack -> count
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling in a background thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="trace sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and write the collapsed stacks"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+    def sample(self):
+        """Capture the current stack of every thread except the sampler itself"""
+        names = { t.ident: t.name for t in threading.enumerate() }
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                co = frame.f_code
+                stack.append(f"{os.path.basename(co.co_filename)}:{co.co_name}")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)).replace(" ", "_"))
+            stack = ";".join(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def write(self):
+        """Write the aggregated stacks to the collapsed stacks file"""
+        with open(self.filename, "w") as f:
+            for stack, count in list(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+    def _loop(self):
+        last_write = time.time()
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if time.time() - last_write > self.write_interval:
+                self.write()
+                last_write = time.time()
+
+
+sampler = None
+
+
+def start(mode: str):
+    """Start tracing in the given mode (see [`MODES`](#MODES)), stops the current mode first"""
+    global MODE, DIRECTORY, SAMPLES_FILENAME, sampler, writer
+    assert mode in MODES, f"Tracing mode has to be one of {', '.join(MODES)}"
+    stop()
+    MODE = mode   # before installing the tracer, it removes itself if the mode is not "full"
+    if mode == "sample":
+        sampler = Sampler(SAMPLES_FILENAME)
+        sampler.start()
+    elif mode == "full":
+        _start_writer()
+        sys.settrace(tracer)
+        threading.settrace(tracer)
+
+
+def stop():
+    """Stop tracing, new threads are no longer traced  
+    `sys.settrace` only affects the calling thread, so running threads remove the [`tracer`](#tracer) themselves on its next call"""
+    global MODE, sampler, writer
+    if MODE == "sample" and sampler is not None:
+        sampler.stop()
+        sampler = None
+    elif MODE == "full":
+        sys.settrace(None)
+        threading.settrace(None)
+    MODE = "off"
+    with rules_lock:
+        if not rules:
+            _stop_writer()
+
+
+def begin(route: str, client_id: str):
+    """Start tracing the current thread if a scoped trace rule matches the request  
+    Returns `True` if tracing was started, call [`end`](#end) once the request is handled"""
+    global MODE, rules
+    if MODE == "full" or not rules:
+        return False
+    now = time.time()
+    with rules_lock:
+        rules[:] = [r for r in rules if r["until"] > now]
+        if not rules:   # all rules expired
+            _stop_writer()
+            return False
+        matches = any((r["route"] is None or r["route"] == route) and (r["client"] is None or r["client"] == client_id) for r in rules)
+        if not matches:
+            return False
+        _start_writer()
+    scoped.active = True
+    sys.settrace(tracer)
+    return True
+
+
+def end():
+    """Stop tracing the current thread"""
+    sys.settrace(None)
+    scoped.active = False
+
+
+def stats():
+    """Get the tracing mode and the measured overhead per traced event"""
+    global MODE, sampler, writer, overhead
+    result = { "mode": MODE }
+    if sampler is not None:
+        result["samples"] = sampler.samples
+        result["stacks"] = len(sampler.stacks)
+    if writer is not None:
+        result["writer"] = writer.stats()
+    result["overhead"] = {
+        "events": overhead["events"],
+        "avg": overhead["time"] / overhead["events"] if overhead["events"] else 0   # seconds spent in the tracer per event
+    }
+    return result
+
+
+def _start_writer():
+    global DIRECTORY, writer
+    if writer is None:
+        writer = TraceWriter(DIRECTORY)
+        writer.start()
+
+
+def _stop_writer():
+    """Write the remaining events and close the segment, unless all threads are traced"""
+    global MODE, writer
+    if writer is not None and MODE != "full":
+        writer.stop()
+        writer = None
+
+
+@API.route("jarvis/debug/trace")
+def debug_trace(args, client, data):
+    """Trace requests of a single route, a single client or all requests for a limited time  
+    Only the worker thread handling a matching request is traced, so all other requests run at full speed.
+    Only root clients may change trace rules. Request:
+    ```python
+    {
+        "route": str|null, # eg. "jarvis/nlu/parse" or "jarvis/client/{id}/set/public-key", null = all routes
+        "client": str|null, # client id, null = all clients
+        "duration": int, # seconds, default SCOPED_DURATION
+        "clear": true|false # remove all rules instead of adding one
+    }
+    ```
+    Returns the active rules: `[ { "route": str|null, "client": str|null, "until": int } ]`"""
+    global rules, writer
+    if not client.get("is-root", False):
+        return False
+    with rules_lock:
+        if data.get("clear", False):
+            rules.clear()
+            _stop_writer()
+        else:
+            rules.append({
+                "route": data.get("route", None),
+                "client": data.get("client", None),
+                "until": int(time.time() + data.get("duration", SCOPED_DURATION))
+            })
+        return list(rules)
+
 
 def tracer(frame, event, arg):
-    global ONLY_JARVIS
+    global ONLY_JARVIS, MODE
+    if MODE != "full" and not getattr(scoped, "active", False):   # tracing was stopped by another thread
+        sys.settrace(None)
+        return None
     co = frame.f_code
     func_name = co.co_name
     if func_name == 'write':
@@ -26,27 +247,30 @@ def tracer(frame, event, arg):
     filename = co.co_filename
     if ONLY_JARVIS and "jarvis" not in filename:
         return tracer
+    start = time.perf_counter()
     if event == 'call':
         fn_args = []
-        for i in range(frame.f_code.co_argcount):
-            name = frame.f_code.co_varnames[i]
-            fn_args.append(f"{name}={frame.f_locals[name]}")
-        insert_trace("call", filename, f"{func_name}({', '.join(fn_args)})", line_no)
+        f_locals = frame.f_locals
+        for i in range(co.co_argcount):
+            name = co.co_varnames[i]
+            fn_args.append(f"{name}={REPR.repr(f_locals.get(name, None))}")
+        insert_trace("call", filename, func_name, line_no, None, ", ".join(fn_args))
+        _measure(start)
         return tracer
     elif event == 'return':
-        insert_trace("return", filename, func_name, arg)
+        insert_trace("return", filename, func_name, line_no, None, REPR.repr(arg))
     elif event == 'exception':
-        co = frame.f_code
-        func_name = co.co_name
-        line_no = frame.f_lineno
-        filename = co.co_filename
         exc_type, exc_value, exc_traceback = arg
-        insert_trace("exception", exc_type.__name__, exc_value, filename, func_name, line_no, exc_traceback)
+        insert_trace("exception", filename, func_name, line_no, exc_type.__name__, REPR.repr(exc_value))
+    _measure(start)
     return
 
-def insert_trace(*args):
-    global FILE, FILENAME, MAX_ALLOWED_FILE_SIZE
-    FILE.write(f"{int(time.time())}::{'::'.join([str(i) for i in args])}\n")
-    if os.path.getsize(FILENAME) > MAX_ALLOWED_FILE_SIZE:
-        pass
-        # shutil.make_archive(FILENAME + "." + str(int(time.time())), "gztar", FILENAME, ".")
+def insert_trace(kind, filename, func_name, line_no, exc_type, detail):
+    global writer
+    if writer is not None:
+        writer.write(kind, filename, func_name, line_no, exc_type, detail)
+
+def _measure(start):
+    global overhead
+    overhead["events"] += 1
+    overhead["time"] += time.perf_counter() - start
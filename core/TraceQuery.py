@@ -0,0 +1,295 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+
+Query binary trace segments written by [`core/TraceWriter`](core/TraceWriter)
+
+Run using:
+```bash
+PYTHONPATH=. python3 -m core.TraceQuery exceptions --file satellite/NLU --start 2021-05-01T10:00 --end 2021-05-01T11:00
+PYTHONPATH=. python3 -m core.TraceQuery tree --thread "mqtt worker 3" --at 1619863200 --window 2
+```
+"""
+
+
+import os
+import glob
+import gzip
+import json
+import mmap
+import shutil
+import argparse
+import tempfile
+from core.TraceWriter import RECORD_STRING, RECORD_THREAD, RECORD_EVENT, MAGIC, iter_records, read_varint, decode_event
+import core.Trace as Trace
+
+
+BLOCK_SIZE = 1024
+"""
+Amount of events per index block, a query only decodes the blocks whose summary matches
+"""
+
+INDEX_VERSION = 1
+
+
+class Segment():
+    """
+    A trace segment (`.jtr` or `.jtr.gz`) and its sidecar index (`<segment>.idx`)
+    The index holds the interned strings, thread names and a summary (time range, files, functions, exception types, threads)
+    for every block of `BLOCK_SIZE` events, so queries never have to read the whole segment
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.compressed = path.endswith(".gz")
+        self.index = None
+
+    @property
+    def index_path(self):
+        return f"{self.path}.idx"
+
+    def load_index(self):
+        """Load the sidecar index, (re)build it if it is missing or outdated"""
+        if self.index is not None:
+            return self.index
+        size = os.path.getsize(self.path)
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            if index["version"] == INDEX_VERSION and index["size"] == size:
+                index["strings"] = { int(k): v for k, v in index["strings"].items() }
+                index["threads"] = { int(k): v for k, v in index["threads"].items() }
+                self.index = index
+                return index
+        except Exception:
+            pass
+        self.index = self.build_index()
+        return self.index
+
+    def build_index(self):
+        """Read the segment once and write the sidecar index"""
+        strings = {}
+        threads = {}
+        blocks = []
+        block = None
+        with self._open() as buffer:
+            for offset, kind, start, end in iter_records(buffer):
+                if kind == RECORD_STRING:
+                    id, pos = read_varint(buffer, start)
+                    strings[id] = bytes(buffer[pos:end]).decode("utf-8", "replace")
+                elif kind == RECORD_THREAD:
+                    ident, pos = read_varint(buffer, start)
+                    threads[ident] = read_varint(buffer, pos)[0]
+                elif kind == RECORD_EVENT:
+                    timestamp, thread, _, file_id, func_id, _, exc_id, _ = decode_event(buffer, start, end)
+                    if block is None or block["events"] >= BLOCK_SIZE:
+                        block = { "offset": offset, "end": end, "events": 0, "first": timestamp, "last": timestamp,
+                                  "files": set(), "functions": set(), "exceptions": set(), "threads": set() }
+                        blocks.append(block)
+                    block["end"] = end
+                    block["events"] += 1
+                    block["first"] = min(block["first"], timestamp)
+                    block["last"] = max(block["last"], timestamp)
+                    block["files"].add(file_id)
+                    block["functions"].add(func_id)
+                    block["threads"].add(thread)
+                    if exc_id:
+                        block["exceptions"].add(exc_id)
+        for block in blocks:
+            for key in ["files", "functions", "exceptions", "threads"]:
+                block[key] = sorted(block[key])
+        index = {
+            "version": INDEX_VERSION,
+            "size": os.path.getsize(self.path),
+            "strings": strings,
+            "threads": { ident: strings.get(name, str(ident)) for ident, name in threads.items() },
+            "first": min([b["first"] for b in blocks], default=None),
+            "last": max([b["last"] for b in blocks], default=None),
+            "blocks": blocks
+        }
+        with open(self.index_path, "w") as f:
+            json.dump(index, f)
+        return index
+
+    def events(self, start: float = None, end: float = None, file: str = None, function: str = None,
+               exception: str = None, thread: str = None):
+        """Yield all events matching the filters (see [`query`](#query)) in this segment"""
+        index = self.load_index()
+        if index["first"] is None or (start is not None and index["last"] < start) or (end is not None and index["first"] > end):
+            return
+        strings = index["strings"]
+        file_ids = _ids(strings, file, lambda s: file in s)
+        func_ids = _ids(strings, function, lambda s: s == function)
+        exc_ids = _ids(strings, exception if isinstance(exception, str) else None, lambda s: s == exception)
+        thread_ids = None
+        if thread is not None:
+            thread_ids = { ident for ident, name in index["threads"].items() if str(ident) == str(thread) or name == thread }
+
+        blocks = [b for b in index["blocks"] if
+                  (start is None or b["last"] >= start) and (end is None or b["first"] <= end) and
+                  (file_ids is None or file_ids.intersection(b["files"])) and
+                  (func_ids is None or func_ids.intersection(b["functions"])) and
+                  (exception is None or (b["exceptions"] and (exc_ids is None or exc_ids.intersection(b["exceptions"])))) and
+                  (thread_ids is None or thread_ids.intersection(b["threads"]))]
+        if not blocks:
+            return
+        with self._open() as buffer:
+            for block in blocks:
+                for _, kind, rstart, rend in iter_records(_View(buffer, block["end"]), block["offset"]):
+                    if kind != RECORD_EVENT:
+                        continue
+                    timestamp, ident, event, file_id, func_id, line, exc_id, detail = decode_event(buffer, rstart, rend)
+                    if (start is not None and timestamp < start) or (end is not None and timestamp > end) or \
+                       (file_ids is not None and file_id not in file_ids) or \
+                       (func_ids is not None and func_id not in func_ids) or \
+                       (exception is not None and not exc_id) or (exc_ids is not None and exc_id not in exc_ids) or \
+                       (thread_ids is not None and ident not in thread_ids):
+                        continue
+                    yield {
+                        "timestamp": timestamp,
+                        "thread": index["threads"].get(ident, str(ident)),
+                        "event": event,
+                        "file": strings.get(file_id, None),
+                        "function": strings.get(func_id, None),
+                        "line": line,
+                        "exception": strings.get(exc_id, None) if exc_id else None,
+                        "detail": detail
+                    }
+
+    def _open(self):
+        """Open the segment as a memory map, compressed segments are decompressed into a temporary file first"""
+        if not self.compressed:
+            return _Mapped(self.path)
+        return _Decompressed(self.path)
+
+
+class _View():
+    """A read-only view of the first `end` bytes of a buffer, without copying"""
+
+    def __init__(self, buffer, end: int) -> None:
+        self.buffer = buffer
+        self.end = end
+
+    def __len__(self):
+        return self.end
+
+    def __getitem__(self, i):
+        return self.buffer[i]
+
+
+class _Mapped():
+    """Memory map a segment file read-only, pages are loaded by the kernel on access and can be evicted at any time"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, "rb")
+        self.map = b""
+        if os.fstat(self.file.fileno()).st_size > len(MAGIC):
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def __exit__(self, *args):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+
+class _Decompressed(_Mapped):
+    """Decompress a gzip segment in chunks into a temporary file and memory map it"""
+
+    def __enter__(self):
+        self.file = tempfile.TemporaryFile(dir=os.path.dirname(self.path))
+        with gzip.open(self.path, "rb") as f:
+            shutil.copyfileobj(f, self.file, 1024 * 1024)
+        self.file.flush()
+        self.map = b""
+        if self.file.tell() > len(MAGIC):
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+
+def _ids(strings: dict, value, match):
+    """Get the ids of all interned strings matching a filter, `None` if there is no filter"""
+    if value is None:
+        return None
+    return { id for id, s in strings.items() if match(s) }
+
+
+def segments(directory: str = None):
+    """List all segments in `directory` (default: the trace directory), oldest first"""
+    directory = directory or Trace.DIRECTORY
+    paths = glob.glob(f"{directory}/*.jtr") + glob.glob(f"{directory}/*.jtr.gz")
+    return [Segment(p) for p in sorted(paths, key=lambda p: os.path.basename(p).split(".")[0])]
+
+
+def query(directory: str = None, start: float = None, end: float = None, file: str = None, function: str = None,
+          exception = None, thread: str = None):
+    """Yield trace events of all segments matching all given filters:
+    * `start`, `end` - unix timestamps
+    * `file` - substring of the file name, eg. `satellite/NLU`
+    * `function` - function name
+    * `exception` - exception type name (eg. `KeyError`), or `True` for all exceptions
+    * `thread` - thread name or ident"""
+    for segment in segments(directory):
+        yield from segment.events(start, end, file, function, exception, thread)
+
+
+def call_tree(thread: str, at: float, window: float = 1, directory: str = None):
+    """Get the calls of `thread` within `window` seconds around `at` as indented lines"""
+    lines = []
+    depth = 0
+    for event in query(directory, at - window, at + window, thread=thread):
+        if event["event"] == "call":
+            lines.append(f"{event['timestamp']:.6f} {'  ' * depth}{event['function']}({event['detail']})  {event['file']}:{event['line']}")
+            depth += 1
+        elif event["event"] == "return":
+            depth = max(depth - 1, 0)
+            lines.append(f"{event['timestamp']:.6f} {'  ' * depth}<- {event['function']} = {event['detail']}")
+        else:
+            lines.append(f"{event['timestamp']:.6f} {'  ' * depth}!! {event['exception']}: {event['detail']}  {event['file']}:{event['line']}")
+    return lines
+
+
+def _timestamp(value: str):
+    try:
+        return float(value)
+    except ValueError:
+        from dateutil.parser import parse as parsedate
+        return parsedate(value).timestamp()
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Query Jarvis trace segments")
+    parser.add_argument("--directory", default=None, help="Trace directory (default: ../logs/trace, relative to the repository)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("index", help="Build missing or outdated segment indexes")
+    for name in ["events", "exceptions"]:
+        cmd = commands.add_parser(name, help=f"List {name}")
+        cmd.add_argument("--start", type=_timestamp, default=None, help="Unix timestamp or date")
+        cmd.add_argument("--end", type=_timestamp, default=None, help="Unix timestamp or date")
+        cmd.add_argument("--file", default=None, help="Substring of the file name")
+        cmd.add_argument("--function", default=None, help="Function name")
+        cmd.add_argument("--thread", default=None, help="Thread name or ident")
+        cmd.add_argument("--type", default=None, help="Exception type name")
+    tree = commands.add_parser("tree", help="Show the call tree of a thread around a point in time")
+    tree.add_argument("--thread", required=True, help="Thread name or ident")
+    tree.add_argument("--at", type=_timestamp, required=True, help="Unix timestamp or date")
+    tree.add_argument("--window", type=float, default=1, help="Seconds before and after --at")
+    args = parser.parse_args(argv)
+
+    if args.command == "index":
+        for segment in segments(args.directory):
+            index = segment.load_index()
+            print(f"{segment.path}: {sum(b['events'] for b in index['blocks'])} events in {len(index['blocks'])} blocks")
+    elif args.command == "tree":
+        for line in call_tree(args.thread, args.at, args.window, args.directory):
+            print(line)
+    else:
+        exception = args.type or (True if args.command == "exceptions" else None)
+        for event in query(args.directory, args.start, args.end, args.file, args.function, exception, args.thread):
+            print(json.dumps(event))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import os
+import gzip
+import time
+import glob
+import shutil
+import struct
+import threading
+from collections import deque
+
+
+SEGMENT_SIZE = 1024 * 1024 * 10   # rotate a segment after 10 MB
+SEGMENT_AGE = 60 * 60   # rotate a segment after an hour
+MAX_SEGMENTS = 20   # keep at most this many (compressed) segments, the oldest are deleted
+FLUSH_INTERVAL = 0.5   # seconds between two writes of buffered events
+MAX_BUFFERED = 100000   # drop events if the writer falls this far behind
+
+MAGIC = b"JTRC\x01"
+"""
+Every segment starts with these bytes (format version 1)
+"""
+
+KINDS = ["call", "return", "exception"]
+
+RECORD_STRING = 1
+RECORD_THREAD = 2
+RECORD_EVENT = 3
+"""
+A segment is a sequence of length-prefixed records `<varint length><payload>`, the first payload byte is the record type:
+* `RECORD_STRING` - `<varint id><utf-8 string>`, interns a file name, function name or exception type
+* `RECORD_THREAD` - `<varint thread ident><varint name id>`, names a thread
+* `RECORD_EVENT` - `<double timestamp><varint thread ident><byte kind><varint file id><varint function id><varint line><varint exception type id><utf-8 detail>`
+
+String ids start at 1 (0 means "none") and are only valid within their segment, so every segment can be read on its own
+"""
+
+
+def varint(n: int):
+    """Encode a non-negative integer as LEB128 varint"""
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def read_varint(buffer, offset: int):
+    """Decode a varint from `buffer` at `offset`, returns `(value, new offset)`"""
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return (result, offset)
+        shift += 7
+
+
+def iter_records(buffer, offset: int = len(MAGIC)):
+    """Iterate over the records of a segment in `buffer` (bytes or mmap)
+    Yields tuples `(record offset, record type, payload start, payload end)`"""
+    end = len(buffer)
+    while offset < end:
+        length, start = read_varint(buffer, offset)
+        if start + length > end:
+            return   # truncated record of a crashed writer
+        yield (offset, buffer[start], start + 1, start + length)
+        offset = start + length
+
+
+def decode_event(buffer, start: int, end: int):
+    """Decode the payload of a `RECORD_EVENT`
+    Returns a tuple `(timestamp, thread, kind, file id, function id, line, exception type id, detail)`"""
+    timestamp, = struct.unpack_from("<d", buffer, start)
+    thread, offset = read_varint(buffer, start + 8)
+    kind = buffer[offset]
+    file_id, offset = read_varint(buffer, offset + 1)
+    func_id, offset = read_varint(buffer, offset)
+    line, offset = read_varint(buffer, offset)
+    exc_id, offset = read_varint(buffer, offset)
+    detail = bytes(buffer[offset:end]).decode("utf-8", "replace")
+    return (timestamp, thread, KINDS[kind], file_id, func_id, line, exc_id, detail)
+
+
+class TraceWriter():
+    """
+    Buffers trace events in memory and writes them from a background thread into compact binary segments
+    Segments are rotated by size and age, rotated segments are compressed with gzip
+    """
+
+    def __init__(self, directory: str, prefix: str = "trace") -> None:
+        """Initialize a writer which stores segments `<prefix>-<timestamp>.jtr[.gz]` in `directory`"""
+        self.directory = directory
+        self.prefix = prefix
+        self.events = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.segments = 0
+        self._buffer = deque()
+        self._file = None
+        self._path = None
+        self._opened_at = 0
+        self._size = 0
+        self._strings = {}
+        self._threads = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self, kind: str, filename: str, func: str, line: int, exc_type: str = None, detail: str = ""):
+        """Queue an event, this is called from the traced threads and only appends to a buffer"""
+        if len(self._buffer) >= MAX_BUFFERED:
+            self.dropped += 1
+            return
+        self._buffer.append((time.time(), threading.get_ident(), kind, filename, func, line, exc_type, detail))
+
+    def start(self):
+        """Start the background writer thread"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="trace writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write all buffered events and close the current segment"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def flush(self):
+        """Encode and write all buffered events"""
+        names = { t.ident: t.name for t in threading.enumerate() }
+        out = bytearray()
+        while self._buffer:
+            if self._file is None or self._size + len(out) > SEGMENT_SIZE or time.time() - self._opened_at > SEGMENT_AGE:
+                self._write(out)
+                out = bytearray()
+                self._rotate()
+            timestamp, thread, kind, filename, func, line, exc_type, detail = self._buffer.popleft()
+            if thread not in self._threads:
+                self._threads.add(thread)
+                self._record(out, bytes([RECORD_THREAD]) + varint(thread) + varint(self._intern(out, names.get(thread, str(thread)))))
+            self._record(out, bytes([RECORD_EVENT]) + struct.pack("<d", timestamp) + varint(thread) + bytes([KINDS.index(kind)]) +
+                              varint(self._intern(out, filename)) + varint(self._intern(out, func)) + varint(line or 0) +
+                              varint(self._intern(out, exc_type) if exc_type else 0) + detail.encode("utf-8", "replace"))
+            self.events += 1
+        self._write(out)
+
+    def stats(self):
+        """Get writer counters"""
+        return {
+            "events": self.events,
+            "dropped": self.dropped,
+            "buffered": len(self._buffer),
+            "bytes": self.bytes,
+            "segments": self.segments,
+            "bytes-per-event": self.bytes / self.events if self.events else 0
+        }
+
+    def _loop(self):
+        while not self._stop.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def _intern(self, out: bytearray, string: str):
+        id = self._strings.get(string, None)
+        if id is None:
+            id = len(self._strings) + 1
+            self._strings[string] = id
+            self._record(out, bytes([RECORD_STRING]) + varint(id) + string.encode("utf-8", "replace"))
+        return id
+
+    def _record(self, out: bytearray, payload: bytes):
+        out += varint(len(payload))
+        out += payload
+
+    def _write(self, out: bytearray):
+        if out:
+            self._file.write(out)
+            self._file.flush()
+            self._size += len(out)
+            self.bytes += len(out)
+
+    def _rotate(self):
+        """Close and compress the current segment, delete the oldest segments and start a new one"""
+        if self._file is not None:
+            self._file.close()
+            with open(self._path, "rb") as src, gzip.open(f"{self._path}.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.unlink(self._path)
+        for old in sorted(glob.glob(f"{self.directory}/{self.prefix}-*.jtr.gz"))[:-MAX_SEGMENTS]:
+            os.unlink(old)
+        for index in glob.glob(f"{self.directory}/{self.prefix}-*.idx"):   # sidecar indexes of core/TraceQuery
+            if not os.path.isfile(index[:-len(".idx")]):
+                os.unlink(index)
+        self._opened_at = time.time()
+        self._path = f"{self.directory}/{self.prefix}-{int(self._opened_at * 1000)}.jtr"
+        self._file = open(self._path, "wb")
+        self._file.write(MAGIC)
+        self._size = len(MAGIC)
+        self._strings = {}
+        self._threads = set()
+        self.segments += 1
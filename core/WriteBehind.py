@@ -0,0 +1,99 @@
+"""
+Copyright (c) 2021 Philipp Scheer
+"""
+
+
+import time
+import threading
+import traceback
+from jarvis import Logger, Exiter
+import core.Couch as Couch
+
+
+logger = Logger("WriteBehind")
+
+
+class WriteBehind():
+    """
+    Coalesces writes of volatile document fields (eg. `last-seen`) and writes them in bulk
+    Instead of saving a document on every change, the latest value of every field is kept in memory
+    and all dirty documents are written together in one `_bulk_docs` request per interval
+    """
+
+    def __init__(self, table: str, interval: float = 30, on_flush = None) -> None:
+        """Initialize a write-behind buffer for `table` which flushes every `interval` seconds
+        `on_flush(doc)` is called with every successfully written document (including its new `_rev`)"""
+        self.table = table
+        self.interval = interval
+        self.on_flush = on_flush
+        self.flushes = 0
+        self.written = 0
+        self.conflicts = 0
+        self._dirty = {}  # id -> { field: value }
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def set(self, id: str, fields: dict):
+        """Mark `fields` of the document `id` to be written with the next flush, newer values overwrite older ones"""
+        with self._lock:
+            self._dirty.setdefault(id, {}).update(fields)
+
+    def flush(self):
+        """Write all pending fields in one bulk request
+        Documents which were modified in the meantime (conflicts) are retried with the next flush"""
+        global logger
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return 0
+            try:
+                table = Couch.table(self.table)
+                docs = table.get_many(dirty.keys())
+                docs = [{**docs[id], **fields} for id, fields in dirty.items() if id in docs]
+                results = table.bulk(docs)
+            except Exception:
+                logger.e("Flush", f"Failed to flush {len(dirty)} documents of table '{self.table}'", traceback.format_exc())
+                self._requeue(dirty)
+                return 0
+            written = 0
+            for doc, result in zip(docs, results):
+                if result.get("ok", False):
+                    doc["_rev"] = result["rev"]
+                    written += 1
+                    if self.on_flush:
+                        self.on_flush(doc)
+                else:
+                    self.conflicts += 1
+                    self._requeue({doc["_id"]: dirty[doc["_id"]]})
+            self.flushes += 1
+            self.written += written
+            return written
+
+    def loop(self):
+        """Flush every `interval` seconds until Jarvis stops, then flush one last time"""
+        global logger
+        while Exiter.running:
+            for i in range(int(self.interval * 2)):
+                if not Exiter.running:
+                    break
+                time.sleep(0.49)
+            self.flush()
+        self.flush()
+        logger.i("Shutdown", f"Flushed pending writes of table '{self.table}'")
+
+    def stats(self):
+        """Get write-behind counters"""
+        with self._lock:
+            return {
+                "pending": len(self._dirty),
+                "flushes": self.flushes,
+                "written": self.written,
+                "conflicts": self.conflicts
+            }
+
+    def _requeue(self, dirty: dict):
+        """Put fields back into the buffer without overwriting values that were set in the meantime"""
+        with self._lock:
+            for id, fields in dirty.items():
+                self._dirty[id] = {**fields, **self._dirty.get(id, {})}
@@ -3,15 +3,60 @@ This module provides classes to handle crucial Jarvis functionalities
 
 Subclasses include:
 
+* [`Cache.py`](core/Cache)  
+A bounded LRU cache with time to live, used for in-process caches
+
+* [`Changes.py`](core/Changes)  
+One shared `_changes` feed per table, in-process code subscribes callbacks to document changes
+
 * [`Checks.py`](core/Checks)  
 Performs system checks before running Jarvis
 
+* [`Config.py`](core/Config)  
+Drop-in `jarvis.Config` which keeps all values in memory, kept current by the `_changes` feed
+
+* [`Couch.py`](core/Couch)  
+Direct HTTP access to CouchDB through a shared pool of keep-alive sessions
+
+* [`Dispatcher.py`](core/Dispatcher)  
+Runs MQTT endpoints on a bounded worker pool, in order per client
+
+* [`Journal.py`](core/Journal)  
+Append-only journal of writes made while the database is unavailable, replayed in bulk once it recovers
+
+* [`Keys.py`](core/Keys)  
+Cache of parsed RSA keys keyed by owner and fingerprint
+
+* [`Metrics.py`](core/Metrics)  
+Fixed bucket latency histograms per endpoint, served by `jarvis/metrics`
+
 * [`MQTTServer.py`](core/MQTTServer)  
 Serves the API via MQTT
 
 * [`Permissions.py`](core/Permissions)  
 Permission handling for API calls
 
+* [`Router.py`](core/Router)  
+Topic trie to resolve MQTT topics to API endpoints
+
+* [`Session.py`](core/Session)  
+Symmetric session keys (AES-GCM) negotiated once with RSA
+
+* [`TokenStore.py`](core/TokenStore)  
+In-memory store of live tokens with heap-based expiry and batched purging
+
+* [`SQLite.py`](core/SQLite)  
+Embedded storage backend with the table interface of `Couch.py`, selected with `JARVIS_DATABASE=sqlite`
+
 * [`Trace.py`](core/Trace)  
 A tracing module to keep track of executing functions and exception tracebacks
+
+* [`TraceQuery.py`](core/TraceQuery)  
+Indexed queries over trace segments, also usable from the command line
+
+* [`TraceWriter.py`](core/TraceWriter)  
+Buffered writer for compact, rotating binary trace segments
+
+* [`WriteBehind.py`](core/WriteBehind)  
+Coalesces writes of volatile fields into periodic bulk writes
 """
\ No newline at end of file
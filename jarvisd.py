@@ -6,24 +6,36 @@
 
 
 import sys
-import threading
+import argparse
 import core.Trace as Trace
 import core.Checks as Checks
 
 
-sys.settrace(Trace.tracer)
-threading.settrace(Trace.tracer)
+parser = argparse.ArgumentParser(description="Jarvis Daemon")
+parser.add_argument("--upgraded", default=False, action="store_true", help="Jarvis was restarted after an upgrade")
+parser.add_argument("--trace", default="off", choices=Trace.MODES, help="Tracing mode: off, sample (statistical stack sampling, low overhead) or full (sys.settrace, slow)")
+args = parser.parse_args()
+
+Trace.start(args.trace)
 
 Checks.check_system()
 
 
 import os
 import traceback
-from jarvis import Logger, Exiter, ThreadPool, API
+from jarvis import Logger, Exiter, ThreadPool
+from core.Router import API
+import core.Changes as Changes
+import core.Couch as Couch
+import core.Journal as Journal
+from core.Config import Config
+import core.Keys as Keys
 import core.MQTTServer as MQTTServer
 import satellite.NLU as NLU
 import satellite.AutoUpdate as AutoUpdate
 import satellite.Analytics as Analytics
+from classes.Client import Client
+from classes.Token import Token
 
 
 CURRENT_FILE = os.path.abspath(sys.argv[0])
@@ -38,14 +50,29 @@ tpool.register(MQTTServer.start_server, "mqtt")
 tpool.register(Analytics.start, "analytics")
 tpool.register(AutoUpdate.update_checker, "update")
 tpool.register(NLU.start_server, "nlu")
+Changes.subscribe("devices", Client.on_change)
+tpool.register(Client.HEARTBEAT.loop, "client heartbeat")
+tpool.register(Token.STORE.loop, "token store")
+tpool.register(Journal.journal.loop, "journal")
 
 
-@API.route("jarvis/status")
+@API.route("jarvis/status", cache=True, ttl=1)
 def jarvis_status(args, client, data):
     global tpool
     result = {}
     for t in tpool.threads:
         result[t.name] = t.is_alive()
+    result["client-cache"] = Client.CACHE.stats()
+    result["dispatcher"] = MQTTServer.dispatcher.stats()
+    result["key-cache"] = Keys.stats()
+    result["client-heartbeat"] = Client.HEARTBEAT.stats()
+    result["token-store"] = Token.STORE.stats()
+    result["config-cache"] = Config.stats()
+    result["changes"] = Changes.stats()
+    result["database-pool"] = Couch.pool.stats()
+    result["journal"] = Journal.journal.stats()
+    result["response-cache"] = API.cache_stats()
+    result["trace"] = Trace.stats()
     return result
 
 @API.route("jarvis/restart")
@@ -55,7 +82,7 @@ def jarvis_restart(args, client, data):
         return False
     logger.i("Restart", "Restarting due to MQTT restart signal")
     try: 
-        os.execv(sys.executable, ["python3", CURRENT_FILE, "--upgraded"])
+        os.execv(sys.executable, ["python3", CURRENT_FILE, "--upgraded", f"--trace={Trace.MODE}"])
     except Exception:
         logger.e("Restart", "Failed to restart Jarvis, see traceback", traceback.format_exc())
 
@@ -68,6 +95,9 @@ def main():
     logger.i("File", f"Running jarvis file {CURRENT_FILE}")
     Exiter.mainloop()
     logger.i("Stop", f"Caught exit signal, exiting")
+    Client.HEARTBEAT.flush()
+    Journal.journal.sync()
+    Trace.stop()
 
 
 if __name__ == "__main__":
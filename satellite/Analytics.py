@@ -6,7 +6,9 @@ Copyright (c) 2021 Philipp Scheer
 import time
 import psutil
 import traceback
-from jarvis import Database, Exiter, Logger, ThreadPool
+from jarvis import Exiter, Logger, ThreadPool
+import core.Couch as Couch
+import core.Journal as Journal
 # from jarvis.Logger import Logger
 
 
@@ -16,8 +18,9 @@ tp = ThreadPool()
 
 
 def start():
-    """Start all analytics processes"""
-    tp.register(analytics_loop, "Database Analytics", [db_analytics])
+    """Start all analytics processes, database analytics are only available for CouchDB"""
+    if Couch.BACKEND == "couchdb":
+        tp.register(analytics_loop, "Database Analytics", [db_analytics])
     tp.register(analytics_loop, "System Analytics", [sys_analytics])
 
 
@@ -57,7 +60,7 @@ def sys_analytics():
                 "sent": psutil.net_io_counters().packets_sent,
                 "received": psutil.net_io_counters().packets_recv
             }}
-    Database().table("analytics").insert({
+    Journal.write(Couch.table("analytics"), {
         "type": "system",
         "timestamp": int(time.time()),
         "stats": {
@@ -72,7 +75,7 @@ def sys_analytics():
 def db_analytics():
     """The actual DB analytics loop which runs in a given interval and collects data and saves to DB"""
     global POLL_INTERVAL
-    stats = Database().stats
+    stats = Couch.node_stats()
     formatted_stats = {}
     formatted_stats["reads"] = stats["couchdb"]["database_reads"]["value"]
     formatted_stats["purges"] = stats["couchdb"]["document_purges"]["total"]["value"]
@@ -82,7 +85,7 @@ def db_analytics():
     for code in [200, 201, 202, 204, 206, 301, 302, 304, 400, 401, 403, 404, 405, 406, 409, 412, 413, 414, 415, 416, 417, 500, 501, 503]:
         formatted_stats["codes"][code] = stats["couchdb"]["httpd_status_codes"][str(code)]["value"]
 
-    Database().table("analytics").insert({
+    Journal.write(Couch.table("analytics"), {
         "type": "db",
         "timestamp": int(time.time()),
         "stats": formatted_stats
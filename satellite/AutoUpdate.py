@@ -8,10 +8,14 @@ import json
 import time
 import shutil
 import requests
+import threading
 import traceback
 from packaging import version
 from dateutil.parser import parse as parsedate
-from jarvis import Logger, Config, Exiter, ThreadPool, API
+from jarvis import Logger, Exiter, ThreadPool
+from core.Router import API
+from core.Config import Config
+import core.Changes as Changes
 
 
 logger = Logger("Update")
@@ -98,6 +102,7 @@ def poll(download=False, install=False):
     * If [`download`]() is set, automatically download the file. Overrides the config setting  
     * If `install` is set, automatically install the update. Overrides the config setting"""
     global CURRENT_ACTION, UPDATE_REPOS, SERVER, VERSION_NAMES, logger, mqtt, cnf, download_progress, download_pending, installation_pending
+    API.invalidate("jarvis/update/status")
     # TODO: install a jarvis repo on my server
     logger.d("Poll", "Skipping poll")
     return
@@ -168,6 +173,7 @@ def poll(download=False, install=False):
                 logger.i("Install", f"Installed update v{remote}")
 
             CURRENT_ACTION = "idle"
+    API.invalidate("jarvis/update/status")
     if do_restart:
         # TODO: fix this variable
         mqtt.publish("jarvis/backend/restart", "{}")
@@ -175,16 +181,23 @@ def poll(download=False, install=False):
         logger.i("Poll", f"No update found on server {SERVER}")
 
 def schedule_loop():
-    """In a loop, check if the scheduled install timestamp has passed and if so, install the update"""
+    """Wait until the scheduled install timestamp has passed and if so, install the update  
+    Changes of `schedule-install` wake the loop up immediately"""
     global logger
+    changed = threading.Event()
+    cnf.get("schedule-install", False)   # load the config cache first, so it is updated before our callback runs
+    Changes.subscribe("config", lambda change: (change.get("doc", None) or {}).get("key", None) == "schedule-install" and changed.set(), include_docs=True)
     while Exiter.running:
         schedule = cnf.get("schedule-install", False)
-        if schedule:
-            if schedule < time.time():
-                logger.i("Schedule", "Running a scheduled installation")
-                cnf.set("schedule-install", False)
-                poll(False, True)
-        time.sleep(1)
+        if schedule and schedule < time.time():
+            logger.i("Schedule", "Running a scheduled installation")
+            cnf.set("schedule-install", False)
+            API.invalidate("jarvis/update/status")
+            poll(False, True)
+            continue
+        if changed.wait(min(schedule - time.time(), 1) if schedule else 1):
+            changed.clear()
+            API.invalidate("jarvis/update/status")
 
 def update_checker():
     """Starts the mainloop (`schedule_loop` and poll loop)"""
@@ -283,7 +296,7 @@ def install_update(args, client, data):
         tpool.register(poll, f"install update {int(time.time())}", [False, True])
         return True
 
-@API.route("jarvis/update/status")
+@API.route("jarvis/update/status", cache=True, ttl=2)
 def update_status(args, client, data):
     """Gets the current update status
     Returns:
@@ -303,7 +316,7 @@ def update_status(args, client, data):
     ```"""
     global CURRENT_ACTION, download_pending, installation_pending, download_progress
     logger.i("Install", "Received MQTT status signal")
-    result = cnf.get("version", {})  # benchmark: 0.17 - 0.2s
+    result = dict(cnf.get("version", {}))  # cached values are shared
     result["success"] = True
     result["current-action"] = CURRENT_ACTION
     result["available"] =   {
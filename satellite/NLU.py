@@ -5,8 +5,12 @@ Copyright (c) 2021 Philipp Scheer
 
 import time
 import json
+import threading
 import traceback
-from jarvis import Exiter, Database, Logger, API
+from jarvis import Exiter, Logger
+from core.Router import API
+import core.Changes as Changes
+import core.Couch as Couch
 import snips_nlu
 
 
@@ -14,7 +18,6 @@ logger = Logger("NLU")
 nlu_engine = snips_nlu.SnipsNLUEngine()
 
 
-QUERY_TIME = 10
 STATISTICS = {
     "trained": False,
     "training": False,
@@ -52,16 +55,22 @@ def start_server():
 def get_assistant_data():
     """Try to retrieve the already fitted NLU data
     If fitted data could be found, return it, else None  
-    This starts an infinite loop which retries to get the data until it has been found or Jarvis stops"""
+    If no data is stored yet, this waits until the `assistant` table changes and retries until the data has been found or Jarvis stops"""
     def _get_assistant_data():
-        res = Database().table("assistant").filter(lambda x: "nlu-data" in x)
-        if res.found:
-            return res[0]["nlu-data"]
+        docs, _ = Couch.table("assistant").find({ "nlu-data": { "$exists": True } }, 1)
+        if docs:
+            return docs[0]["nlu-data"]
         return None
-    assistant_data = None
-    while not assistant_data and Exiter.running:
-        time.sleep(QUERY_TIME)
+    changed = threading.Event()
+    callback = Changes.subscribe("assistant", lambda change: changed.set())
+    try:
         assistant_data = _get_assistant_data()
+        while not assistant_data and Exiter.running:
+            if changed.wait(1):
+                changed.clear()
+                assistant_data = _get_assistant_data()
+    finally:
+        Changes.unsubscribe("assistant", callback)
     return assistant_data
 
 def save_assistant_data(data):
@@ -75,13 +84,13 @@ def save_assistant_data(data):
         "nlu-data": ... up to 256Mb data size (MQTT spec limits) ...
     }
     ```"""
-    assistant_table = Database().table("assistant")
-    res = assistant_table.filter(lambda x: "nlu-data" in x)
-    if res.found:
-        res.update(data)
+    assistant_table = Couch.table("assistant")
+    docs, _ = assistant_table.find({ "nlu-data": { "$exists": True } }, 1)
+    if docs:
+        assistant_table.put({ **docs[0], **data })
     else:
         data["created-at"] = int(time.time())
-        assistant_table.insert(data)
+        assistant_table.put(data)
 
 def parse_nlu_model(utterance):
     """Let the NLU engine parse the given string utterance (should be a sentence)  
@@ -110,6 +119,7 @@ def train_nlu_model(data):
     """Train the NLU model with given `data`"""
     global nlu_engine, logger, STATISTICS
     STATISTICS["training"] = True
+    API.invalidate("jarvis/nlu/status")
     logger.i("Training", f"Starting NLU model training")
     try:
         start = time.time()
@@ -123,6 +133,7 @@ def train_nlu_model(data):
     STATISTICS["trained"] = nlu_engine.fitted
     STATISTICS["training"] = False
     STATISTICS["avg-time"]["training"] = STATISTICS["total-time"]["training"] / STATISTICS["count"]["training"]
+    API.invalidate("jarvis/nlu/status")
 
 
 @API.route("jarvis/nlu/train")
@@ -155,7 +166,7 @@ def parse_nlu(args, client, data):
         return {"success": False, "error": "No utterance provided!"}
     return parse_nlu_model(data["utterance"])
 
-@API.route("jarvis/nlu/status")
+@API.route("jarvis/nlu/status", cache=True, ttl=5)
 def nlu_status(args, client, data):
     """Starts a status server
     Returns an object: {    trained: True|False, 
@@ -0,0 +1,441 @@
+"""
+Reproducible benchmarks of the storage, crypto and dispatch hot paths
+Runs offline against in-process stand-ins with fixed seeds and warm-up:
+* a CouchDB stand-in (HTTP, backed by `core/SQLite`) on the CouchDB port, used by `core/Couch`, `jarvis.Database` and `jarvis.Config`
+* an MQTT broker stand-in on the MQTT port, used by `jarvis.MQTT`
+
+The benchmark refuses to run if a real CouchDB or MQTT broker listens on these ports, so it never touches real data.
+
+Run using:
+```bash
+PYTHONPATH=. python3 tests/benchmark.py                          # print results, compare with tests/benchmark-baseline.json if it exists
+PYTHONPATH=. python3 tests/benchmark.py --save-baseline          # store the results as new baseline
+PYTHONPATH=. python3 tests/benchmark.py --filter client --output results.json
+```
+Exits with code 1 if a benchmark is more than `--tolerance` slower (median) than the baseline, or if a benchmark of the baseline did not run.
+Baselines depend on the hardware, create one per machine before comparing
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import statistics
+import socketserver
+import traceback
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+SEED = 1337
+BASELINE = f"{os.path.dirname(os.path.abspath(__file__))}/benchmark-baseline.json"
+DIRECTORY = tempfile.mkdtemp(prefix="jarvis-benchmark-")
+MQTT_PORT = 1883   # default broker port of jarvis.MQTT
+
+os.environ["JARVIS_DATABASE"] = "couchdb"
+import core.Couch as Couch
+import core.SQLite as SQLite
+import core.Journal as Journal
+from core.Couch import ConflictError
+SQLite.FILENAME = f"{DIRECTORY}/standin.sqlite"
+Journal.journal = Journal.Journal(f"{DIRECTORY}/journal.jsonl")
+
+
+class CouchHandler(BaseHTTPRequestHandler):
+    """
+    Serves the subset of the CouchDB HTTP API used by `core/Couch` and `jarvis.Database` from `core/SQLite` tables, with keep-alive
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True   # headers and body are separate writes, avoid the delayed ACK stall
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method: str):
+        url = urlparse(self.path)
+        query = { k: v[0] for k, v in parse_qs(url.query).items() }
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        parts = [unquote(p) for p in url.path.strip("/").split("/")]
+        try:
+            status, result = self.route(method, parts, query, body)
+        except ConflictError as e:
+            status, result = 409, { "error": "conflict", "reason": str(e) }
+        data = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if method != "HEAD":
+            self.wfile.write(data)
+
+    def route(self, method: str, parts: list, query: dict, body: dict):
+        if parts[0] == "":
+            return (200, { "couchdb": "Welcome", "version": "3.1.1" })
+        if parts[0] == "_node":
+            return (200, { "couchdb": {} })
+        table = SQLite.Table(parts[0])
+        endpoint = parts[1] if len(parts) > 1 else ""
+        if endpoint == "":   # tables exist as soon as a document is written
+            if method == "POST":
+                return (201, table.put(body))
+            return (201 if method == "PUT" else 200, { "ok": True } if method == "PUT" else { "db_name": parts[0] })
+        if endpoint == "_all_docs":
+            if body is not None and "keys" in body:
+                docs = table.get_many(body["keys"])
+                return (200, { "rows": [{ "id": k, "key": k, "doc": docs[k] } if k in docs else { "key": k, "error": "not_found" } for k in body["keys"]] })
+            startkey = json.loads(query["startkey"]) if "startkey" in query else None
+            docs = table.all_docs(int(query.get("limit", 1000)), startkey, int(query.get("skip", 0)))
+            return (200, { "rows": [{ "id": d["_id"], "key": d["_id"], "doc": d } for d in docs] })
+        if endpoint == "_bulk_docs":
+            return (201, table.bulk(body["docs"]))
+        if endpoint == "_find":
+            docs, bookmark = table.find(body["selector"], body.get("limit", 25), body.get("bookmark", None), body.get("sort", None), body.get("fields", None))
+            return (200, { "docs": docs, "bookmark": bookmark })
+        if endpoint == "_index":
+            created = table.create_index(body["name"], body["index"]["fields"])
+            return (200, { "result": "created" if created else "exists" })
+        if endpoint == "_changes":
+            since = query.get("since", "now")
+            results, last_seq = table.changes(since, int(query.get("timeout", 30000)) / 1000, query.get("include_docs", "false") == "true")
+            return (200, { "results": results, "last_seq": last_seq })
+        if method == "PUT":
+            return (201, table.put({ **body, "_id": endpoint }))
+        if method == "DELETE":
+            return (200, table.put({ "_id": endpoint, "_rev": query.get("rev", None), "_deleted": True }))
+        doc = table.get(endpoint)
+        return (200, doc) if doc is not None else (404, { "error": "not_found", "reason": "missing" })
+
+
+class MQTTHandler(socketserver.BaseRequestHandler):
+    """
+    A minimal MQTT 3.1.1 broker: connect, (un)subscribe with `+` and `#` wildcards, publish (forwarded with QoS 0) and ping
+    """
+
+    subscriptions = {}   # handler -> [topic filter]
+    lock = threading.Lock()
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+
+    def handle(self):
+        try:
+            while True:
+                header = self.read(1)[0]
+                length, shift = 0, 0
+                while True:
+                    byte = self.read(1)[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                self.packet(header >> 4, header & 0x0F, self.read(length))
+        except (ConnectionError, OSError, StopIteration):
+            pass
+        finally:
+            with MQTTHandler.lock:
+                MQTTHandler.subscriptions.pop(self, None)
+
+    def packet(self, kind: int, flags: int, data: bytes):
+        if kind == 1:   # CONNECT
+            self.send(0x20, b"\x00\x00")
+        elif kind == 3:   # PUBLISH
+            n = int.from_bytes(data[:2], "big")
+            topic, offset = data[2:2 + n].decode("utf-8"), 2 + n
+            qos = (flags >> 1) & 3
+            if qos:
+                packet_id, offset = data[offset:offset + 2], offset + 2
+                self.send(0x40 if qos == 1 else 0x50, packet_id)   # PUBACK / PUBREC
+            forward = len(topic.encode("utf-8")).to_bytes(2, "big") + topic.encode("utf-8") + data[offset:]
+            with MQTTHandler.lock:
+                receivers = [h for h, filters in MQTTHandler.subscriptions.items() if any(matches(f, topic) for f in filters)]
+            for handler in receivers:
+                handler.send(0x30, forward)
+        elif kind == 6:   # PUBREL
+            self.send(0x70, data[:2])
+        elif kind == 8:   # SUBSCRIBE
+            filters, offset = [], 2
+            while offset < len(data):
+                n = int.from_bytes(data[offset:offset + 2], "big")
+                filters.append(data[offset + 2:offset + 2 + n].decode("utf-8"))
+                offset += 3 + n
+            with MQTTHandler.lock:
+                MQTTHandler.subscriptions.setdefault(self, []).extend(filters)
+            self.send(0x90, data[:2] + b"\x00" * len(filters))
+        elif kind == 10:   # UNSUBSCRIBE
+            self.send(0xB0, data[:2])
+        elif kind == 12:   # PINGREQ
+            self.send(0xD0, b"")
+        elif kind == 14:   # DISCONNECT
+            raise StopIteration()
+
+    def read(self, n: int):
+        data = b""
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("closed")
+            data += chunk
+        return data
+
+    def send(self, header: int, data: bytes):
+        length, encoded = len(data), b""
+        while True:
+            byte, length = length & 0x7F, length >> 7
+            encoded += bytes([byte | (0x80 if length else 0)])
+            if not length:
+                break
+        with self.send_lock:
+            self.request.sendall(bytes([header]) + encoded + data)
+
+
+class MQTTServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True   # connections of a previous run may linger in TIME_WAIT, a running broker still blocks the port
+
+
+def matches(topic_filter: str, topic: str):
+    """Check if `topic` matches an MQTT topic filter with `+` and `#` wildcards"""
+    levels, parts = topic_filter.split("/"), topic.split("/")
+    for i, level in enumerate(levels):
+        if level == "#":
+            return True
+        if i >= len(parts) or (level != "+" and level != parts[i]):
+            return False
+    return len(levels) == len(parts)
+
+
+def start_standins():
+    """Start the CouchDB stand-in on the CouchDB port and the MQTT broker stand-in on the MQTT port
+    Exits if a port is in use, the benchmark must not write into a real database or broker"""
+    try:
+        couch = ThreadingHTTPServer((Couch.HOST, Couch.PORT), CouchHandler)
+        mqtt = MQTTServer(("127.0.0.1", MQTT_PORT), MQTTHandler)
+    except OSError as e:
+        print(f"Cannot start the stand-ins, stop CouchDB and the MQTT broker first: {e}", file=sys.stderr)
+        exit(2)
+    for server, name in [(couch, "couchdb stand-in"), (mqtt, "mqtt stand-in")]:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name=name, daemon=True).start()
+
+
+def measure(name: str, fn, iterations: int, warmup: int = None):
+    """Run `fn` `warmup` times, then measure `iterations` runs. Returns per-run statistics in microseconds"""
+    random.seed(SEED)
+    for i in range(warmup if warmup is not None else max(iterations // 10, 1)):
+        fn()
+    times = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1e6)
+    times.sort()
+    result = {
+        "iterations": iterations,
+        "mean": statistics.mean(times),
+        "median": statistics.median(times),
+        "p90": times[int(len(times) * 0.9)],
+        "min": times[0]
+    }
+    print(f"{name:<36} median {result['median']:>12.2f}us   p90 {result['p90']:>12.2f}us", file=sys.stderr)
+    return result
+
+
+def bench_config():
+    from core.Config import Config
+    cnf = Config()   # reads the table through core/Couch, writes through jarvis.Config like in production
+    for i in range(100):
+        cnf.set(f"benchmark-{i}", { "value": i })
+    counter = iter(range(10 ** 9))
+    return {
+        "config.get": measure("config.get", lambda: cnf.get(f"benchmark-{random.randrange(100)}"), 100000),
+        "config.get (reload table)": measure("config.get (reload table)", lambda: (Config.clear(), cnf.get("benchmark-0")), 100),
+        "config.set": measure("config.set", lambda: cnf.set("benchmark-set", next(counter)), 300)
+    }
+
+
+def bench_client():
+    from classes.Client import Client
+    ids = []
+    for i in range(200):
+        c = Client.new({ "name": f"Benchmark {i}", "device": random.choice(["phone", "mic", "computer"]) })
+        c.set_data("payload", "".join(random.choice("abcdef0123456789") for _ in range(256)))
+        c.save()
+        ids.append(c.id)
+    cl = Client.load(ids[0])
+    counter = iter(range(10 ** 9))
+    def uncached():
+        id = random.choice(ids)
+        Client.CACHE.invalidate(id)
+        Client.load(id)
+    def save():
+        cl.set("name", f"Benchmark {next(counter)}")
+        cl.save()
+    return {
+        "client.load (cached)": measure("client.load (cached)", lambda: Client.load(random.choice(ids)), 100000),
+        "client.load (uncached)": measure("client.load (uncached)", uncached, 1000),
+        "client.save (unchanged)": measure("client.save (unchanged)", cl.save, 100000),
+        "client.save": measure("client.save", save, 300),
+        "client.reload": measure("client.reload", cl.reload, 100000)
+    }
+
+
+def bench_token():
+    from classes.Token import Token
+    tokens = [t.token for t in Token.new_many(1000, 1, 3600)]
+    def missing():
+        try:
+            Token.load("missing")
+        except Exception:
+            pass
+    Token.STORE.load()
+    return {
+        "token.load": measure("token.load", lambda: Token.load(random.choice(tokens)), 100000),
+        "token.load (missing)": measure("token.load (missing)", missing, 100000),
+        "token.new_many (1000)": measure("token.new_many (1000)", lambda: Token.new_many(1000, 1, 3600), 10, 1)
+    }
+
+
+def bench_crypto():
+    from jarvis import Crypto
+    results = {}
+    message = bytes(random.getrandbits(8) for _ in range(32))   # eg. a symmetric key
+    for bits in [1024, 2048, 4096]:
+        priv, pub = Crypto.keypair(bits)
+        encrypted = Crypto.encrypt(message, pub)
+        assert Crypto.decrypt(encrypted, priv) == message, "Crypto class is not working"
+        results[f"crypto.encrypt ({bits})"] = measure(f"crypto.encrypt ({bits})", lambda: Crypto.encrypt(message, pub), 200)
+        results[f"crypto.decrypt ({bits})"] = measure(f"crypto.decrypt ({bits})", lambda: Crypto.decrypt(encrypted, priv), 50 if bits == 4096 else 200)
+    return results
+
+
+def bench_dispatch():
+    """Round trips of an encrypted request from a `jarvis.MQTT` client through the broker to `on_message` and of the encrypted reply back"""
+    from jarvis import MQTT, Crypto
+    from classes.Client import Client
+    import core.Permissions as Permissions
+    import core.MQTTServer as MQTTServer
+    import core.Routing
+    MQTTServer.start()
+    priv, pub = Crypto.keypair(Permissions.KEYLEN)
+    client = Client.new({ "name": "Benchmark MQTT", "public-key": pub, "activated": True })
+    client.save()
+    replies = threading.Semaphore(0)
+    mqtt = MQTT(client.id, priv, pub, Permissions.PUBLIC_KEY)
+    mqtt.on_message(lambda topic, message, client_id: replies.release())
+    mqtt.subscribe("benchmark/reply")
+    for i in range(100):   # subscriptions are asynchronous, wait until replies arrive
+        mqtt.publish("jarvis/server/get/public-key", { "reply-to": "benchmark/reply" })
+        if replies.acquire(timeout=0.1):
+            break
+    while replies.acquire(timeout=0.5):
+        pass
+    def message(topic, data):
+        def run():
+            mqtt.publish(topic, { **data(), "reply-to": "benchmark/reply" })
+            assert replies.acquire(timeout=10), "No reply received"
+        return run
+    return {
+        "dispatch.on_message (set info)": measure("dispatch.on_message (set info)", message("jarvis/client/set/info", lambda: { "device": random.choice(["phone", "mic"]) }), 300),
+        "dispatch.on_message (set value)": measure("dispatch.on_message (set value)", message("jarvis/client/set", lambda: { "key": "benchmark", "value": random.random() }), 300)
+    }
+
+
+BENCHMARKS = {
+    "config": bench_config,
+    "client": bench_client,
+    "token": bench_token,
+    "crypto": bench_crypto,
+    "dispatch": bench_dispatch
+}
+
+
+def compare(results: dict, baseline: dict, groups: list, tolerance: float):
+    """Compare the medians with a baseline, returns the names of all benchmarks which got slower than `tolerance` allows
+    and of all benchmarks of the selected `groups` which are in the baseline but did not run"""
+    regressions = []
+    for name, base in baseline.items():
+        if name.split(".")[0] not in groups:
+            continue
+        if name not in results:
+            regressions.append(name)
+            print(f"{name:<36}   MISSING", file=sys.stderr)
+            continue
+        ratio = results[name]["median"] / base["median"] if base["median"] else 1
+        slower = ratio > 1 + tolerance
+        if slower:
+            regressions.append(name)
+        print(f"{name:<36} {ratio:>6.2f}x baseline{'   REGRESSION' if slower else ''}", file=sys.stderr)
+    return regressions
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Jarvis hot path benchmarks")
+    parser.add_argument("--filter", default=None, help=f"Only run benchmark groups containing this string ({', '.join(BENCHMARKS)})")
+    parser.add_argument("--output", default=None, help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline results to compare with")
+    parser.add_argument("--save-baseline", default=False, action="store_true", help="Store the results as baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown of the median before it is reported as regression")
+    args = parser.parse_args(argv)
+
+    start_standins()
+    groups = [group for group in BENCHMARKS if args.filter is None or args.filter in group]
+    results, failed = {}, []
+    for group in groups:
+        try:
+            results.update(BENCHMARKS[group]())
+        except Exception:
+            failed.append(group)
+            print(f"Benchmark group '{group}' failed:\n{traceback.format_exc()}", file=sys.stderr)
+
+    output = json.dumps({ "seed": SEED, "python": sys.version.split()[0], "results": results, "failed": failed }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.save_baseline:
+        if failed:
+            print(f"Not saving the baseline, failed groups: {', '.join(failed)}", file=sys.stderr)
+            return 1
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)["results"]
+        with open(args.baseline, "w") as f:
+            f.write(json.dumps({ "seed": SEED, "python": sys.version.split()[0], "results": { **baseline, **results } }, indent=2))
+        return 0
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f)["results"], groups, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,61 @@
+"""
+Run using:
+```bash
+PYTHONPATH=. python3 tests/client-speed-test.py
+```
+"""
+
+import copy
+import time
+import random
+from classes.Client import Client
+
+ITERATIONS = 1000
+PAYLOAD_KEYS = 5000
+
+random.seed(0)
+
+cl = Client.new({ "name": "Speed Test" })
+for i in range(PAYLOAD_KEYS):
+    cl.set_data(f"key-{i}", ''.join(random.choice("abcdef1234567890") for i in range(32)))
+cl.save()
+
+print(f"{ITERATIONS} iterations, {PAYLOAD_KEYS} keys in client data")
+
+start = time.time()
+for i in range(ITERATIONS):
+    cl.save()
+print(f"Save without changes: {(time.time() - start)/ITERATIONS*1e6 :.2f}us")
+
+start = time.time()
+for i in range(ITERATIONS // 100):
+    cl.set("name", f"Speed Test {i}")
+    cl.save()
+print(f"Save with changes: {(time.time() - start)/(ITERATIONS // 100)*1e3 :.2f}ms")
+
+start = time.time()
+for i in range(ITERATIONS):
+    cl.reload()
+print(f"Reload (cached, in place): {(time.time() - start)/ITERATIONS*1e6 :.2f}us")
+
+start = time.time()
+for i in range(ITERATIONS):
+    copy.deepcopy(Client.CACHE.get(cl.id))
+print(f"Reload (cached, deepcopy as before): {(time.time() - start)/ITERATIONS*1e6 :.2f}us")
+
+Client.CACHE.invalidate(cl.id)
+start = time.time()
+for i in range(ITERATIONS // 100):
+    Client.CACHE.invalidate(cl.id)
+    cl.reload()
+print(f"Reload (uncached): {(time.time() - start)/(ITERATIONS // 100)*1e3 :.2f}ms")
+
+
+"""
+Result (save/reload with changes depend on the database, the other numbers are in-process only):
+
+1000 iterations, 5000 keys in client data
+Save without changes: 0.17us
+Reload (cached, in place): 4.12us
+Reload (cached, deepcopy as before): 3938.62us
+"""
@@ -0,0 +1,55 @@
+"""
+Run using:
+```bash
+PYTHONPATH=. python3 tests/router-speed-test.py
+```
+"""
+
+import re
+import time
+import random
+from core.Router import API
+
+ROUTES = 400
+ITERATIONS = 100000
+
+random.seed(0)
+
+patterns = []
+for i in range(ROUTES):
+    topic = f"jarvis/bench{i % 20}/route{i}/" + random.choice(["get", "set", "{id}/set/public-key", "{id}/get"])
+    API.register(topic, lambda args, client, data: args)
+    patterns.append(re.compile("^" + re.sub(r"\{(\w+)\}", r"(?P<\1>[^/]+)", topic) + "$"))
+
+topics = [f"jarvis/bench{i % 20}/route{i}/get" for i in range(ROUTES)] + \
+         [f"jarvis/bench{i % 20}/route{i}/client-{i}/set/public-key" for i in range(ROUTES)]
+topics = [random.choice(topics) for i in range(ITERATIONS)]
+
+print(f"{ROUTES} routes, {ITERATIONS} iterations")
+
+start = time.time()
+for topic in topics:
+    for pattern in patterns:
+        if pattern.match(topic):
+            break
+print(f"Linear regex scan: {(time.time() - start)/ITERATIONS*1e6 :.2f}us")
+
+start = time.time()
+for topic in topics:
+    API._match(API.root, topic.split("/"), 0)
+print(f"Trie match: {(time.time() - start)/ITERATIONS*1e6 :.2f}us")
+
+start = time.time()
+for topic in topics:
+    API.resolve(topic)
+print(f"Memoized resolve: {(time.time() - start)/ITERATIONS*1e6 :.2f}us")
+
+
+"""
+Result:
+
+400 routes, 100000 iterations
+Linear regex scan: 110.00us
+Trie match: 1.48us
+Memoized resolve: 0.96us
+"""
@@ -0,0 +1,41 @@
+"""
+Run using:
+```bash
+PYTHONPATH=. python3 tests/trace-test.py
+```
+"""
+
+import sys
+import threading
+import core.Trace as Trace
+
+traced = []
+
+def worker():
+    traced.append(sys.gettrace())
+
+Trace.start("full")
+assert sys.gettrace() is Trace.tracer, "the main thread has to be traced"
+thread = threading.Thread(target=worker)
+thread.start()
+thread.join()
+assert traced == [Trace.tracer], "new threads have to be traced"
+
+Trace.stop()
+assert sys.gettrace() is None and Trace.writer is None
+
+# scoped rules stop the writer once they are cleared or expired
+root = { "is-root": True }
+Trace.debug_trace(None, root, { "route": "jarvis/test" })
+assert Trace.begin("jarvis/test", "client") and Trace.writer is not None
+Trace.end()
+Trace.debug_trace(None, root, { "clear": True })
+assert Trace.writer is None
+
+Trace.debug_trace(None, root, { "route": "jarvis/test" })
+assert Trace.begin("jarvis/test", "client")
+Trace.end()
+Trace.rules[0]["until"] = 0
+assert not Trace.begin("jarvis/test", "client")
+assert Trace.rules == [] and Trace.writer is None
+print("Trace tests passed")